@@ -1,4 +1,4 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file, Response
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file, Response, stream_with_context
 from flask_mail import Mail, Message
 from flask_cors import CORS
 from dotenv import load_dotenv
@@ -6,18 +6,23 @@ from twilio.rest import Client
 from twilio.base.exceptions import TwilioRestException
 from twilio.twiml.messaging_response import MessagingResponse
 from flask_jwt_extended import JWTManager, jwt_required, create_access_token, get_jwt_identity, set_access_cookies, unset_jwt_cookies, decode_token
-from pydantic import BaseModel, Field, ValidationError, RootModel
+from pydantic import BaseModel, Field, ValidationError, RootModel, TypeAdapter
 import re
 import os
 import requests
 import time
-import PyPDF2
+import threading
 import json
+import hashlib
+import base64
+import csv
+import io
 import logging
 import bcrypt
-from sqlalchemy import create_engine, Column, Integer, String, Text, ForeignKey, DateTime, Boolean
-from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy import create_engine, Column, Integer, String, Text, ForeignKey, DateTime, Boolean, LargeBinary, Index, select, insert, update, or_, and_
+from sqlalchemy.orm import declarative_base, sessionmaker, deferred, undefer
 from sqlalchemy.sql import func
+from sqlalchemy.exc import IntegrityError
 from requests.exceptions import HTTPError, Timeout
 import redis
 from redis.connection import ConnectionPool
@@ -25,10 +30,17 @@ from redis.retry import Retry
 from redis.backoff import ExponentialBackoff
 from celery import Celery
 from contextlib import contextmanager
-from datetime import timedelta
+from datetime import datetime, timedelta, timezone
 import uuid
-from ratelimit import limits, sleep_and_retry
-import magic
+from cache import TwoTierCache, ResponseCache
+from knowledge import IndexCache, build_index_bytes, index_digest
+from pdf_ingest import PDFIngestError, download_pdf, extract_text
+from prompt_builder import PromptBuilder, estimate_messages_tokens, estimate_tokens
+from llm_client import LLMClient, parse_route_timeouts
+from rate_limiter import TokenBucket
+from write_behind import BatchWriter
+from twilio_numbers import NumberRegistry, twilio_number_fetcher
+from celery.signals import worker_process_shutdown
 
 # Configuración inicial
 load_dotenv()
@@ -52,10 +64,10 @@ logger = logging.getLogger(__name__)
 # Configuración de CORS
 CORS(app, resources={r"/*": {
     "origins": ["http://localhost:3000", "http://localhost:5000", "http://192.168.0.213:5000", "https://www.plubot.com"],
-    "methods": ["GET", "POST", "OPTIONS", "DELETE", "PUT"],
+    "methods": ["GET", "POST", "OPTIONS", "DELETE", "PUT", "PATCH"],
     "allow_headers": ["Content-Type", "Authorization"],
     "supports_credentials": True,
-    "expose_headers": ["Content-Type", "Authorization"]
+    "expose_headers": ["Content-Type", "Authorization", "ETag"]
 }})
 
 # Configuración de Redis con mejoras
@@ -162,8 +174,30 @@ app.config['MAIL_PASSWORD'] = os.getenv('MAIL_PASSWORD')
 app.config['MAIL_DEFAULT_SENDER'] = os.getenv('MAIL_DEFAULT_SENDER')
 mail = Mail(app)
 
-# Configuración de Twilio
+# Configuración de Twilio (TWILIO_API_URL permite apuntar a un servidor local: python twilio_numbers.py)
 twilio_client = Client(TWILIO_SID, TWILIO_TOKEN)
+if os.getenv('TWILIO_API_URL'):
+    twilio_client.api.base_url = os.getenv('TWILIO_API_URL')
+
+# Cliente del LLM compartido (XAI_API_URL permite apuntar a un servidor local: python llm_client.py)
+llm_client = LLMClient(
+    XAI_API_KEY,
+    base_url=os.getenv('XAI_API_URL', 'https://api.x.ai/v1'),
+    model=os.getenv('XAI_MODEL', 'grok-2-1212'),
+    max_concurrency=int(os.getenv('LLM_MAX_CONCURRENCY', 16)),
+    pool_size=int(os.getenv('LLM_POOL_SIZE', 16)),
+    timeouts=parse_route_timeouts(os.getenv('LLM_ROUTE_TIMEOUTS'), {'chat': 30, 'api': 10})
+)
+
+# Límite global de llamadas a xAI compartido por todos los workers y tareas (token bucket en Redis)
+XAI_RATE_LIMIT_PER_MINUTE = int(os.getenv('XAI_RATE_LIMIT_PER_MINUTE', 50))
+XAI_RATE_LIMIT_WAIT = float(os.getenv('XAI_RATE_LIMIT_WAIT', 2))
+xai_rate_limiter = TokenBucket(
+    lambda: redis_client,
+    'xai',
+    rate=XAI_RATE_LIMIT_PER_MINUTE / 60,
+    capacity=int(os.getenv('XAI_RATE_LIMIT_BURST', XAI_RATE_LIMIT_PER_MINUTE))
+)
 
 # Configuración de JWT
 app.config["JWT_SECRET_KEY"] = "super-secret"
@@ -198,10 +232,25 @@ class Chatbot(Base):
     whatsapp_number = Column(String, unique=True)
     business_info = Column(Text)
     pdf_url = Column(String)
-    pdf_content = Column(Text)
+    # Puede ocupar megas: solo se carga cuando se accede al atributo o se pide con undefer()
+    pdf_content = deferred(Column(Text))
+    # Índice BM25 de los fragmentos del PDF (ver knowledge.py), generado por process_pdf_async
+    pdf_index = deferred(Column(LargeBinary))
+    # index_digest(pdf_index): el perfil identifica el índice sin leer la columna grande
+    pdf_index_digest = Column(String(16))
+    # SHA-256 del PDF del que salen pdf_content y pdf_index (ver PDFDocument)
+    pdf_sha256 = Column(String(64))
+    # Máximo de tokens del prompt enviado al LLM; None usa PROMPT_TOKEN_BUDGET
+    prompt_token_budget = Column(Integer)
+    # Se incrementa con cada cambio de flujos/edges; sirve de ETag y de clave para cachés
+    version = Column(Integer, nullable=False, default=1, server_default='1')
     image_url = Column(String)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
 
+    __table_args__ = (
+        Index('ix_chatbots_user_id', 'user_id'),
+    )
+
 class Conversation(Base):
     __tablename__ = 'conversations'
     id = Column(Integer, primary_key=True, autoincrement=True)
@@ -211,6 +260,11 @@ class Conversation(Base):
     role = Column(String, nullable=False)
     timestamp = Column(DateTime, server_default=func.now())
 
+    __table_args__ = (
+        Index('ix_conversations_chatbot_user_timestamp', 'chatbot_id', 'user_id', 'timestamp'),
+        Index('ix_conversations_chatbot_timestamp_id', 'chatbot_id', 'timestamp', 'id'),
+    )
+
 class Flow(Base):
     __tablename__ = 'flows'
     id = Column(Integer, primary_key=True, autoincrement=True)
@@ -221,6 +275,10 @@ class Flow(Base):
     intent = Column(String)
     condition = Column(Text, default="")  # Nuevo campo
 
+    __table_args__ = (
+        Index('ix_flows_chatbot_position', 'chatbot_id', 'position'),
+    )
+
 class FlowEdge(Base):
     __tablename__ = 'flow_edges'
     id = Column(Integer, primary_key=True, autoincrement=True)
@@ -229,6 +287,10 @@ class FlowEdge(Base):
     target_flow_id = Column(Integer, ForeignKey('flows.id'), nullable=False)
     condition = Column(Text, default="")
 
+    __table_args__ = (
+        Index('ix_flow_edges_chatbot_id', 'chatbot_id'),
+    )
+
 class MessageQuota(Base):
     __tablename__ = 'message_quotas'
     id = Column(Integer, primary_key=True)
@@ -237,6 +299,10 @@ class MessageQuota(Base):
     message_count = Column(Integer, default=0)
     plan = Column(String, default='free')
 
+    __table_args__ = (
+        Index('uq_message_quotas_user_month', 'user_id', 'month', unique=True),
+    )
+
 class Template(Base):
     __tablename__ = 'templates'
     id = Column(Integer, primary_key=True)
@@ -246,7 +312,17 @@ class Template(Base):
     flows = Column(Text, nullable=False)
     description = Column(Text, nullable=False)
 
-Base.metadata.create_all(engine)
+# Texto e índice de cada PDF distinto, por SHA-256 de sus bytes, compartidos entre chatbots
+class PDFDocument(Base):
+    __tablename__ = 'pdf_documents'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    sha256 = Column(String(64), nullable=False, unique=True)
+    size = Column(Integer, nullable=False)
+    content = deferred(Column(Text, nullable=False))
+    pdf_index = deferred(Column(LargeBinary))
+    created_at = Column(DateTime, server_default=func.now())
+
+# El esquema se gestiona con migraciones versionadas: python migrations.py upgrade
 Session = sessionmaker(bind=engine)
 
 @contextmanager
@@ -261,6 +337,71 @@ def get_session():
     finally:
         session.close()
 
+# Inserción diferida de Conversation: los mensajes se encolan y se insertan por lotes
+conversation_writer = BatchWriter(
+    engine,
+    Conversation.__table__,
+    batch_size=int(os.getenv('CONVERSATION_BATCH_SIZE', 200)),
+    flush_interval=float(os.getenv('CONVERSATION_FLUSH_INTERVAL', 0.5)),
+    max_queue=int(os.getenv('CONVERSATION_QUEUE_SIZE', 10000)),
+    parent=('chatbot_id', Chatbot.__table__.c.id)
+)
+
+# Ventana de contexto por conversación: lista acotada en Redis (context:<chatbot>:<usuario>) con los
+# últimos CONTEXT_WINDOW_SIZE mensajes; si falta, se siembra con una consulta limitada a la base de datos.
+CONTEXT_WINDOW_SIZE = int(os.getenv('CONTEXT_WINDOW_SIZE', 10))
+CONTEXT_WINDOW_TTL = int(os.getenv('CONTEXT_WINDOW_TTL', 7 * 24 * 3600))
+
+def push_context(chatbot_id, user_id, role, message):
+    if not redis_client:
+        return
+    key = f"context:{chatbot_id}:{user_id}"
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.rpush(key, json.dumps({'role': role, 'message': message}, ensure_ascii=False))
+        pipe.ltrim(key, -CONTEXT_WINDOW_SIZE, -1)
+        pipe.expire(key, CONTEXT_WINDOW_TTL)
+        pipe.execute()
+    except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+        logger.warning(f"Error al actualizar ventana de contexto: {str(e)}.")
+
+def load_context_window(chatbot_id, user_id, session):
+    key = f"context:{chatbot_id}:{user_id}"
+    if redis_client:
+        try:
+            window = redis_client.lrange(key, 0, -1)
+            if window:
+                return [json.loads(item) for item in window]
+        except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+            logger.warning(f"Error al leer ventana de contexto: {str(e)}. Usando la base de datos.")
+
+    rows = session.query(Conversation.role, Conversation.message).filter_by(chatbot_id=chatbot_id, user_id=user_id).order_by(Conversation.timestamp.desc(), Conversation.id.desc()).limit(CONTEXT_WINDOW_SIZE).all()
+    history = [{'role': row.role, 'message': row.message} for row in reversed(rows)]
+    if history and redis_client:
+        try:
+            pipe = redis_client.pipeline()
+            pipe.delete(key)
+            pipe.rpush(key, *[json.dumps(item, ensure_ascii=False) for item in history])
+            pipe.expire(key, CONTEXT_WINDOW_TTL)
+            pipe.execute()
+        except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+            logger.warning(f"Error al sembrar ventana de contexto: {str(e)}.")
+    return history
+
+def record_conversation(chatbot_id, user_id, message, role):
+    conversation_writer.submit({
+        'chatbot_id': chatbot_id,
+        'user_id': user_id,
+        'message': message,
+        'role': role,
+        'timestamp': datetime.now(timezone.utc)
+    })
+    push_context(chatbot_id, user_id, role, message)
+
+@worker_process_shutdown.connect
+def flush_conversation_writer(**kwargs):
+    conversation_writer.close()
+
 # Modelos Pydantic para validación
 class LoginModel(BaseModel):
     email: str = Field(..., min_length=5)
@@ -285,6 +426,104 @@ class FlowModel(BaseModel):
     intent: str = Field(default="general", min_length=1)
     condition: str = Field(default="", min_length=0)
 
+# Cambios parciales de flujos y edges (PATCH): los flujos existentes se identifican por id y los
+# nuevos por una referencia temporal (ref) que los edges pueden usar como source/target
+class FlowAddModel(FlowModel):
+    ref: str | None = None
+    position: int | None = Field(default=None, ge=0)
+
+class FlowChangeModel(BaseModel):
+    id: int
+    user_message: str | None = Field(default=None, min_length=1)
+    bot_response: str | None = Field(default=None, min_length=1)
+    intent: str | None = Field(default=None, min_length=1)
+    condition: str | None = None
+    position: int | None = Field(default=None, ge=0)
+
+class EdgeAddModel(BaseModel):
+    source: int | str
+    target: int | str
+    condition: str = ""
+
+class EdgeChangeModel(BaseModel):
+    id: int
+    condition: str
+
+class FlowsDeltaModel(BaseModel):
+    add: list[FlowAddModel] = []
+    update: list[FlowChangeModel] = []
+    remove: list[int] = []
+
+class EdgesDeltaModel(BaseModel):
+    add: list[EdgeAddModel] = []
+    update: list[EdgeChangeModel] = []
+    remove: list[int] = []
+
+class FlowPatchModel(BaseModel):
+    version: int | None = None
+    flows: FlowsDeltaModel = FlowsDeltaModel()
+    edges: EdgesDeltaModel = EdgesDeltaModel()
+
+# Valida la lista completa en una sola pasada del validador compilado de pydantic
+flow_list_adapter = TypeAdapter(list[FlowModel])
+
+def validate_flows(flows_raw):
+    """Devuelve (flujos validados como dicts, None) o (None, mensaje de error)."""
+    try:
+        validated = flow_list_adapter.validate_python(flows_raw or [])
+    except ValidationError as e:
+        error = e.errors()[0]
+        index = error['loc'][0] if error['loc'] else 0
+        logger.warning(f"Flujo inválido en posición {index}. Error: {str(e)}")
+        return None, f"Flujo inválido en la posición {index}: {error['msg']} ({'.'.join(str(part) for part in error['loc'][1:])})"
+
+    flows = []
+    user_messages = set()
+    for index, flow in enumerate(validated):
+        user_msg = flow.user_message.strip().lower()
+        if not user_msg or not flow.bot_response.strip():
+            return None, f'El flujo en la posición {index} tiene mensajes vacíos. Tanto el mensaje del usuario como la respuesta del bot deben estar llenos.'
+        if user_msg in user_messages:
+            return None, f'El mensaje de usuario "{user_msg}" en la posición {index} está duplicado en los flujos.'
+        user_messages.add(user_msg)
+        flows.append(flow.model_dump())
+    return flows, None
+
+def save_flows_and_edges(session, chatbot_id, flows, edges):
+    # Un INSERT ... RETURNING para todos los flujos (en el orden de los parámetros) en lugar de un
+    # flush por flujo, y otro INSERT masivo para los edges con los IDs obtenidos
+    rows = [
+        {
+            'chatbot_id': chatbot_id,
+            'user_message': flow['user_message'],
+            'bot_response': flow['bot_response'],
+            'position': index,
+            'intent': flow.get('intent', 'general'),
+            'condition': flow.get('condition', '')
+        }
+        for index, flow in enumerate(flows)
+        if flow.get('user_message') and flow.get('bot_response')
+    ]
+    flow_id_map = {}
+    if rows:
+        ids = session.scalars(insert(Flow).returning(Flow.id, sort_by_parameter_order=True), rows).all()
+        flow_id_map = {str(row['position']): flow_id for row, flow_id in zip(rows, ids)}
+
+    edge_rows = []
+    for edge in edges or []:
+        source_id = flow_id_map.get(str(edge.get('source')))
+        target_id = flow_id_map.get(str(edge.get('target')))
+        if source_id and target_id:
+            edge_rows.append({
+                'chatbot_id': chatbot_id,
+                'source_flow_id': source_id,
+                'target_flow_id': target_id,
+                'condition': edge.get('condition') or ''
+            })
+    if edge_rows:
+        session.execute(insert(FlowEdge), edge_rows)
+    return flow_id_map
+
 class MenuItemModel(BaseModel):
     precio: float = Field(..., gt=0)
     descripcion: str = Field(..., min_length=1)
@@ -293,57 +532,142 @@ class MenuModel(RootModel):
     root: dict[str, dict[str, MenuItemModel]]
 
 # Funciones auxiliares
-def extract_text_from_pdf(file_stream):
+def build_system_prompt(name, tone, purpose):
+    return f"Eres un chatbot {tone} llamado '{name}'. Tu propósito es {purpose}. Usa un tono {tone} y gramática correcta."
+
+# Presupuesto de tokens del prompt (estimados localmente, ver prompt_builder.py): sistema, negocio,
+# fragmentos del PDF e historial se recortan por prioridad para no superarlo
+PROMPT_TOKEN_BUDGET = int(os.getenv('PROMPT_TOKEN_BUDGET', 1500))
+PROMPT_MIN_TOKEN_BUDGET = int(os.getenv('PROMPT_MIN_TOKEN_BUDGET', 256))
+TOKEN_USAGE_TTL = int(os.getenv('TOKEN_USAGE_TTL', 90 * 24 * 3600))
+
+def token_usage_key(chatbot_id, month=None):
+    return f"tokens:{chatbot_id}:{month or datetime.now(timezone.utc).strftime('%Y-%m')}"
+
+def record_token_usage(chatbot_id, prompt_tokens, completion_tokens):
+    logger.info(f"Tokens estimados chatbot {chatbot_id}: prompt {prompt_tokens}, respuesta {completion_tokens}")
+    if chatbot_id is None or not redis_client:
+        return
+    key = token_usage_key(chatbot_id)
     try:
-        reader = PyPDF2.PdfReader(file_stream)
-        text = ""
-        for page in reader.pages:
-            text += page.extract_text() or ""
-        return text
-    except Exception as e:
-        logger.exception(f"Error al extraer texto del PDF: {str(e)}")
-        return ""
+        pipe = redis_client.pipeline()
+        pipe.hincrby(key, 'requests', 1)
+        pipe.hincrby(key, 'prompt_tokens', prompt_tokens)
+        pipe.hincrby(key, 'completion_tokens', completion_tokens)
+        pipe.expire(key, TOKEN_USAGE_TTL)
+        pipe.execute()
+    except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+        logger.warning(f"Error al registrar uso de tokens del chatbot {chatbot_id}: {str(e)}")
+
+# Del PDF solo se envían al LLM los fragmentos más relevantes para el mensaje, no el texto completo
+KNOWLEDGE_TOP_K = int(os.getenv('KNOWLEDGE_TOP_K', 3))
+KNOWLEDGE_CHUNK_WORDS = int(os.getenv('KNOWLEDGE_CHUNK_WORDS', 120))
+KNOWLEDGE_CHUNK_OVERLAP = int(os.getenv('KNOWLEDGE_CHUNK_OVERLAP', 30))
+knowledge_indexes = IndexCache(max_entries=int(os.getenv('KNOWLEDGE_CACHE_SIZE', 64)))
+
+def load_pdf_index(chatbot_id):
+    with get_session() as session:
+        return session.query(Chatbot.pdf_index).filter_by(id=chatbot_id).scalar()
 
-def summarize_history(history):
-    if len(history) > 5:
-        return "Resumen: " + " ".join([conv.message[:50] for conv in history[-5:]])
-    return " ".join([conv.message for conv in history])
+def retrieve_knowledge(profile, user_message):
+    if not profile.get('knowledge_digest'):
+        return []
+    index = knowledge_indexes.get(profile['id'], profile['knowledge_digest'], lambda: load_pdf_index(profile['id']))
+    return index.search(user_message, k=KNOWLEDGE_TOP_K) if index else []
+
+def build_chat_messages(profile, history, user_message):
+    # Los fragmentos van en el turno del usuario para que el prompt de sistema (y la caché de
+    # respuestas, que se indexa por él) no cambie con cada pregunta
+    builder = PromptBuilder(profile.get('token_budget') or PROMPT_TOKEN_BUDGET)
+    messages, usage = builder.build(
+        profile['system_prompt'], user_message,
+        business_info=profile.get('business_info'),
+        knowledge=retrieve_knowledge(profile, user_message),
+        history=history
+    )
+    if usage['truncated']:
+        logger.info(f"Prompt del chatbot {profile['id']} recortado en {', '.join(usage['truncated'])}: {usage['total']}/{usage['budget']} tokens")
+    return messages
+
+# Caché en dos niveles (LRU en proceso + Redis) con namespaces invalidables por chatbot
+app_cache = TwoTierCache(
+    lambda: redis_client,
+    max_entries=int(os.getenv('CACHE_L1_MAX_ENTRIES', 4096)),
+    max_bytes=int(os.getenv('CACHE_L1_MAX_BYTES', 32 * 1024 * 1024)),
+    namespace_refresh=float(os.getenv('CACHE_NAMESPACE_REFRESH', 2.0))
+)
 
-@sleep_and_retry
-@limits(calls=50, period=60)
-def call_grok(messages, max_tokens=150):
+# Caché de respuestas del LLM por chatbot (pregunta normalizada + hash del prompt de sistema)
+response_cache = ResponseCache(
+    app_cache,
+    threshold=float(os.getenv('RESPONSE_CACHE_THRESHOLD', 0.85)),
+    ttl=int(os.getenv('RESPONSE_CACHE_TTL', 3600))
+)
+
+# Perfil compilado del chatbot: metadatos y prompt de sistema ya construido. Vive en el namespace
+# chatbot:{id}, así que update_bot, delete_bot y el procesamiento del PDF lo invalidan junto con
+# las respuestas cacheadas. Los mensajes que resuelve un flujo no necesitan el prompt de sistema.
+BOT_PROFILE_TTL = int(os.getenv('BOT_PROFILE_TTL', 3600))
+
+def compile_bot_profile(chatbot):
+    return {
+        'id': chatbot.id,
+        'user_id': chatbot.user_id,
+        'name': chatbot.name,
+        'whatsapp_number': chatbot.whatsapp_number,
+        'system_prompt': build_system_prompt(chatbot.name, chatbot.tone, chatbot.purpose),
+        'business_info': chatbot.business_info,
+        'token_budget': chatbot.prompt_token_budget,
+        'knowledge_digest': chatbot.pdf_index_digest
+    }
+
+def get_bot_profile(chatbot_id, session):
+    profile = app_cache.get(f"chatbot:{chatbot_id}", 'profile')
+    if profile:
+        return profile
+    # pdf_content y pdf_index siguen diferidos: el índice se carga aparte solo si hace falta buscar en él
+    chatbot = session.query(Chatbot).filter_by(id=chatbot_id).first()
+    if not chatbot:
+        return None
+    profile = compile_bot_profile(chatbot)
+    app_cache.set(f"chatbot:{chatbot_id}", 'profile', profile, ttl=BOT_PROFILE_TTL)
+    return profile
+
+def shareable_response(history):
+    # La caché de respuestas se comparte entre todos los usuarios del chatbot: siempre se consulta,
+    # pero solo se guarda lo generado sin historial, para no servir a un cliente respuestas basadas
+    # en la conversación (y los datos) de otro
+    return not history
+
+def call_grok(messages, max_tokens=150, chatbot_id=None, question=None, share_response=True):
     if len(messages) > 4:
         messages = [messages[0]] + messages[-3:]
 
-    cache_key = json.dumps(messages)
-    result = None
+    # Con chatbot_id y question la clave ignora el historial, que cambia en cada mensaje
+    use_response_cache = chatbot_id is not None and bool(question)
 
-    if redis_client and ensure_redis_connection():
-        try:
-            result = redis_client.get(cache_key)
-            if result:
-                logger.info("Respuesta obtenida desde caché")
-                return result
-        except redis.exceptions.ConnectionError as e:
-            logger.warning(f"Error al leer desde Redis: {str(e)}. Continuando sin caché.")
-        except redis.exceptions.TimeoutError as e:
-            logger.warning(f"Timeout en Redis: {str(e)}. Continuando sin caché.")
+    if use_response_cache:
+        result = response_cache.get(chatbot_id, messages[0]['content'], question)
+    else:
+        result = app_cache.get('llm', messages)
+    if result:
+        logger.info("Respuesta obtenida desde caché")
+        return result
+
+    if not xai_rate_limiter.acquire(timeout=XAI_RATE_LIMIT_WAIT):
+        logger.warning("Límite de solicitudes a xAI alcanzado. Respondiendo sin llamar a la IA.")
+        return "Estamos atendiendo muchas consultas en este momento. Intenta de nuevo en unos segundos."
 
-    url = "https://api.x.ai/v1/chat/completions"
-    headers = {"Authorization": f"Bearer {XAI_API_KEY}", "Content-Type": "application/json"}
-    payload = {"model": "grok-2-1212", "messages": messages, "temperature": 0.5, "max_tokens": max_tokens}
     try:
-        logger.info(f"Enviando solicitud a xAI con payload: {json.dumps(payload)}")
-        response = requests.post(url, json=payload, headers=headers, timeout=30)
-        response.raise_for_status()
-        result = response.json()['choices'][0]['message']['content']
+        logger.info(f"Enviando solicitud a xAI con mensajes: {json.dumps(messages)}")
+        result = llm_client.complete(messages, max_tokens=max_tokens, route='chat')
+        record_token_usage(chatbot_id, estimate_messages_tokens(messages), estimate_tokens(result))
 
-        if redis_client and ensure_redis_connection():
-            try:
-                redis_client.setex(cache_key, 3600, result)
-                logger.info("Respuesta guardada en caché")
-            except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
-                logger.warning(f"Error al guardar en Redis: {str(e)}. Continuando sin caché.")
+        if use_response_cache:
+            if share_response:
+                response_cache.set(chatbot_id, messages[0]['content'], question, result)
+        else:
+            app_cache.set('llm', messages, result)
 
         logger.info(f"Grok response: {result}")
         return result
@@ -362,26 +686,211 @@ def call_grok(messages, max_tokens=150):
             return "Error de autenticación con la IA. Contacta al soporte."
         return f"Error con la IA (código {status}). Intenta de nuevo más tarde."
 
-@celery_app.task
-def process_pdf_async(chatbot_id, pdf_url):
+# Mensaje de bienvenida: el chatbot se crea con un mensaje provisional y la tarea
+# generate_welcome_message pide el definitivo al LLM. Se cachea por nombre, tono, propósito y hash
+# de business_info, así que los clones y los bots creados desde una plantilla lo reutilizan.
+WELCOME_MESSAGE_TTL = int(os.getenv('WELCOME_MESSAGE_TTL', 30 * 24 * 3600))
+
+def welcome_placeholder(name):
+    return f"¡Hola! Soy {name}. ¿En qué puedo ayudarte?"
+
+def welcome_cache_key(name, tone, purpose, business_info):
+    business_hash = hashlib.sha256((business_info or '').encode('utf-8')).hexdigest()
+    return [name, tone, purpose, business_hash]
+
+def build_welcome_messages(name, tone, purpose, business_info):
+    messages, _ = PromptBuilder(PROMPT_TOKEN_BUDGET).build(
+        build_system_prompt(name, tone, purpose), "Dame un mensaje de bienvenida.", business_info=business_info
+    )
+    return messages
+
+@celery_app.task(bind=True, max_retries=3, default_retry_delay=10)
+def generate_welcome_message(self, chatbot_id):
     with get_session() as session:
-        response = requests.get(pdf_url)
-        pdf_content = extract_text_from_pdf(response.content)
         chatbot = session.query(Chatbot).filter_by(id=chatbot_id).first()
-        if chatbot:
-            chatbot.pdf_content = pdf_content
+        if not chatbot:
+            logger.warning(f"Chatbot {chatbot_id} no encontrado al generar el mensaje de bienvenida")
+            return None
+        key = welcome_cache_key(chatbot.name, chatbot.tone, chatbot.purpose, chatbot.business_info)
+        initial_message = app_cache.get('welcome', key)
+        if not initial_message:
+            # Se llama al cliente directamente: los mensajes de error de call_grok no deben
+            # quedar guardados como bienvenida; ante un fallo se reintenta la tarea
+            if not xai_rate_limiter.acquire(timeout=XAI_RATE_LIMIT_WAIT):
+                raise self.retry()
+            messages = build_welcome_messages(chatbot.name, chatbot.tone, chatbot.purpose, chatbot.business_info)
+            try:
+                initial_message = llm_client.complete(messages, max_tokens=100, route='chat')
+            except requests.exceptions.RequestException as e:
+                logger.warning(f"Error al generar el mensaje de bienvenida del chatbot {chatbot_id}: {str(e)}")
+                raise self.retry(exc=e)
+            record_token_usage(chatbot_id, estimate_messages_tokens(messages), estimate_tokens(initial_message))
+            app_cache.set('welcome', key, initial_message, ttl=WELCOME_MESSAGE_TTL)
+        chatbot.initial_message = initial_message
+        session.commit()
+        invalidate_bot_list(chatbot.user_id)
+    logger.info(f"Mensaje de bienvenida del chatbot {chatbot_id} generado")
+    return initial_message
+
+# Ingesta de PDF: descarga en streaming a un archivo temporal con tope de tamaño, verificación
+# del tipo con python-magic y extracción de páginas (en paralelo solo si el worker puede crear
+# procesos; en el pool prefork de Celery, una sola pasada; ver pdf_ingest.py). El texto y
+# el índice se guardan una vez por SHA-256 del contenido en pdf_documents; de cada URL se recuerda
+# en Redis su ETag/Last-Modified y el hash, para que volver a procesar un PDF sin cambios cueste
+# solo un GET condicional con respuesta 304.
+PDF_MAX_BYTES = int(os.getenv('PDF_MAX_BYTES', 20 * 1024 * 1024))
+PDF_DOWNLOAD_TIMEOUT = float(os.getenv('PDF_DOWNLOAD_TIMEOUT', 30))
+PDF_WORKERS = int(os.getenv('PDF_WORKERS', 4))
+PDF_PAGES_PER_TASK = int(os.getenv('PDF_PAGES_PER_TASK', 8))
+PDF_PROGRESS_INTERVAL = float(os.getenv('PDF_PROGRESS_INTERVAL', 1.0))
+PDF_SOURCE_TTL = int(os.getenv('PDF_SOURCE_TTL', 30 * 24 * 3600))
+
+def pdf_source_key(pdf_url):
+    return f"pdf:source:{hashlib.sha256(pdf_url.encode('utf-8')).hexdigest()}"
+
+def get_pdf_source(pdf_url):
+    if not redis_client:
+        return {}
+    try:
+        return redis_client.hgetall(pdf_source_key(pdf_url))
+    except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+        logger.warning(f"Error al leer metadatos del PDF {pdf_url}: {str(e)}. Descargando completo.")
+        return {}
+
+def save_pdf_source(pdf_url, downloaded):
+    if not redis_client:
+        return
+    mapping = {'sha256': downloaded.sha256, 'etag': downloaded.etag or '', 'last_modified': downloaded.last_modified or ''}
+    try:
+        pipe = redis_client.pipeline()
+        pipe.hset(pdf_source_key(pdf_url), mapping=mapping)
+        pipe.expire(pdf_source_key(pdf_url), PDF_SOURCE_TTL)
+        pipe.execute()
+    except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+        logger.warning(f"Error al guardar metadatos del PDF {pdf_url}: {str(e)}.")
+
+def pdf_document_exists(sha256):
+    with get_session() as session:
+        return session.query(PDFDocument.id).filter_by(sha256=sha256).first() is not None
+
+def store_pdf_document(sha256, size, content, pdf_index):
+    with get_session() as session:
+        try:
+            session.add(PDFDocument(sha256=sha256, size=size, content=content, pdf_index=pdf_index))
             session.commit()
-        logger.info(f"PDF procesado para chatbot {chatbot_id}")
+        except IntegrityError:
+            # Otro worker procesó el mismo PDF a la vez
+            session.rollback()
+
+def attach_pdf_document(chatbot_id, sha256):
+    with get_session() as session:
+        chatbot = session.query(Chatbot).filter_by(id=chatbot_id).first()
+        if not chatbot or chatbot.pdf_sha256 == sha256:
+            return False
+        document = session.query(PDFDocument).options(
+            undefer(PDFDocument.content), undefer(PDFDocument.pdf_index)
+        ).filter_by(sha256=sha256).one()
+        chatbot.pdf_content = document.content
+        chatbot.pdf_index = document.pdf_index
+        chatbot.pdf_index_digest = index_digest(document.pdf_index)
+        chatbot.pdf_sha256 = sha256
+        session.commit()
+    app_cache.invalidate(f"chatbot:{chatbot_id}")
+    return True
+
+@celery_app.task(bind=True)
+def process_pdf_async(self, chatbot_id, pdf_url):
+    started = time.perf_counter()
+    source = get_pdf_source(pdf_url)
+    # Solo se pide 304 si el documento de la última descarga sigue guardado
+    conditional = bool(source.get('sha256')) and pdf_document_exists(source['sha256'])
+    try:
+        downloaded = download_pdf(
+            pdf_url, PDF_MAX_BYTES, timeout=(5, PDF_DOWNLOAD_TIMEOUT),
+            etag=source.get('etag') if conditional else None,
+            last_modified=source.get('last_modified') if conditional else None
+        )
+    except (PDFIngestError, requests.exceptions.RequestException) as e:
+        logger.warning(f"No se pudo descargar el PDF de {pdf_url} para chatbot {chatbot_id}: {str(e)}")
+        return {'status': 'error', 'message': str(e)}
+
+    if downloaded is None:
+        attached = attach_pdf_document(chatbot_id, source['sha256'])
+        logger.info(f"PDF de chatbot {chatbot_id} sin cambios en origen ({time.perf_counter() - started:.2f}s)")
+        return {'status': 'success', 'sha256': source['sha256'], 'source': 'not_modified', 'updated': attached}
+
+    try:
+        if pdf_document_exists(downloaded.sha256):
+            logger.info(f"PDF {downloaded.sha256[:12]} ya procesado; reutilizando texto e índice")
+            origin = 'deduplicated'
+        else:
+            store_pdf_document(downloaded.sha256, downloaded.size, *extract_pdf_document(self, chatbot_id, downloaded.path))
+            origin = 'extracted'
+    except Exception as e:
+        # Un PDF corrupto no debe borrar el contenido procesado anteriormente
+        logger.exception(f"Error al extraer texto del PDF del chatbot {chatbot_id}: {str(e)}")
+        return {'status': 'error', 'message': str(e)}
+    finally:
+        os.unlink(downloaded.path)
+
+    save_pdf_source(pdf_url, downloaded)
+    attached = attach_pdf_document(chatbot_id, downloaded.sha256)
+    logger.info(f"PDF procesado para chatbot {chatbot_id} ({origin}) en {time.perf_counter() - started:.2f}s")
+    return {'status': 'success', 'sha256': downloaded.sha256, 'source': origin, 'updated': attached}
+
+def extract_pdf_document(task, chatbot_id, path):
+    started = time.perf_counter()
+    last_report = 0.0
+    slowest = 0.0
+
+    def report(done, total, seconds):
+        nonlocal last_report, slowest
+        slowest = max(slowest, seconds)
+        logger.debug(f"Chatbot {chatbot_id}: página {done}/{total} extraída en {seconds:.3f}s")
+        now = time.monotonic()
+        if done == total or now - last_report >= PDF_PROGRESS_INTERVAL:
+            last_report = now
+            try:
+                task.update_state(state='PROGRESS', meta={'pages_done': done, 'pages_total': total})
+            except Exception as e:
+                logger.warning(f"No se pudo publicar el progreso del PDF del chatbot {chatbot_id}: {str(e)}")
+
+    pdf_content = extract_text(path, workers=PDF_WORKERS, pages_per_task=PDF_PAGES_PER_TASK, progress=report)
+    extracted = time.perf_counter()
+    pdf_index = build_index_bytes(pdf_content, KNOWLEDGE_CHUNK_WORDS, KNOWLEDGE_CHUNK_OVERLAP)
+    logger.info(
+        f"Texto del PDF del chatbot {chatbot_id} extraído en {extracted - started:.2f}s "
+        f"(página más lenta {slowest:.2f}s), índice en {time.perf_counter() - extracted:.2f}s, "
+        f"{len(pdf_content)} caracteres"
+    )
+    return pdf_content, pdf_index
+
+# Números entrantes de la cuenta de Twilio en un set de Redis, renovado por Celery beat y a demanda
+TWILIO_NUMBERS_REFRESH_INTERVAL = int(os.getenv('TWILIO_NUMBERS_REFRESH_INTERVAL', 600))
+# Las peticiones solo descargan el inventario si beat lleva varios ciclos sin renovarlo
+TWILIO_NUMBERS_STALE_AFTER = int(os.getenv('TWILIO_NUMBERS_STALE_AFTER', 3 * TWILIO_NUMBERS_REFRESH_INTERVAL))
+twilio_numbers = NumberRegistry(
+    twilio_number_fetcher(twilio_client, TWILIO_SID, page_size=int(os.getenv('TWILIO_NUMBERS_PAGE_SIZE', 1000))),
+    lambda: redis_client,
+    stale_after=TWILIO_NUMBERS_STALE_AFTER,
+    min_refresh_interval=int(os.getenv('TWILIO_NUMBERS_MIN_REFRESH_INTERVAL', 30))
+)
+
+@celery_app.task
+def refresh_twilio_numbers():
+    try:
+        return twilio_numbers.refresh()
+    except TwilioRestException as e:
+        logger.exception(f"Error al actualizar los números de Twilio: {str(e)}")
+        return None
 
 def validate_whatsapp_number(number):
     if not number.startswith('+'):
         number = '+' + number
     try:
-        phone_numbers = twilio_client.api.accounts(TWILIO_SID).incoming_phone_numbers.list()
-        for phone in phone_numbers:
-            if phone.phone_number == number:
-                logger.info(f"Número {number} encontrado en tu cuenta Twilio.")
-                return True
+        if twilio_numbers.contains(number):
+            logger.info(f"Número {number} encontrado en tu cuenta Twilio.")
+            return True
         logger.warning(f"Número {number} no está registrado en tu cuenta Twilio.")
         return False
     except TwilioRestException as e:
@@ -410,8 +919,21 @@ def get_quota():
     logger.info(f"Solicitud recibida en /api/quota. Headers: {request.headers}")
     logger.info(f"Cookies: {request.cookies}")
     user_id = get_jwt_identity()
+    current_month = time.strftime("%Y-%m")
+    if redis_client:
+        try:
+            counter = redis_client.hgetall(quota_counter_key(user_id, current_month))
+            if counter:
+                plan = counter.get('plan', 'free')
+                return jsonify({
+                    'plan': plan,
+                    'messages_used': int(counter.get('count', 0)),
+                    'messages_limit': FREE_PLAN_MESSAGE_LIMIT if plan == 'free' else 999999
+                })
+        except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+            logger.warning(f"Error al leer cuota desde Redis: {str(e)}. Usando la base de datos.")
+
     with get_session() as session:
-        current_month = time.strftime("%Y-%m")
         quota = session.query(MessageQuota).filter_by(user_id=user_id, month=current_month).first()
         return jsonify({
             'plan': quota.plan if quota else 'free',
@@ -429,6 +951,152 @@ def increment_quota(user_id, session):
     session.commit()
     return quota
 
+# Cuotas de mensajes en Redis: hash quota:<usuario>:<mes> con count y plan. El script incrementa y
+# compara de forma atómica; quota:dirty acumula los contadores que flush_quota_counters debe volcar
+# a MessageQuota. Sin Redis se usan check_quota/increment_quota contra la base de datos.
+FREE_PLAN_MESSAGE_LIMIT = 100
+QUOTA_COUNTER_TTL = 40 * 24 * 3600
+QUOTA_FLUSH_INTERVAL = int(os.getenv('QUOTA_FLUSH_INTERVAL', 60))
+QUOTA_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return {-1, ''}
+end
+local plan = redis.call('HGET', KEYS[1], 'plan')
+local count = redis.call('HINCRBY', KEYS[1], 'count', 1)
+if plan == 'free' and count > tonumber(ARGV[1]) then
+    redis.call('HINCRBY', KEYS[1], 'count', -1)
+    return {0, plan}
+end
+redis.call('SADD', KEYS[2], KEYS[1])
+return {count, plan}
+"""
+
+# Script registrado una sola vez por cliente de Redis (se vuelve a registrar si el cliente cambia)
+_quota_script = (None, None)
+
+def get_quota_script(client):
+    global _quota_script
+    script_client, script = _quota_script
+    if script is None or script_client is not client:
+        script = client.register_script(QUOTA_SCRIPT)
+        _quota_script = (client, script)
+    return script
+
+def quota_counter_key(user_id, month):
+    return f"quota:{user_id}:{month}"
+
+def seed_quota_counter(user_id, month, session):
+    quota = session.query(MessageQuota).filter_by(user_id=user_id, month=month).first()
+    if not quota:
+        try:
+            quota = MessageQuota(user_id=user_id, month=month, message_count=0, plan='free')
+            session.add(quota)
+            session.commit()
+        except IntegrityError:
+            # Otro worker creó la fila a la vez (índice único por usuario y mes)
+            session.rollback()
+            quota = session.query(MessageQuota).filter_by(user_id=user_id, month=month).one()
+    key = quota_counter_key(user_id, month)
+    pipe = redis_client.pipeline()
+    pipe.hsetnx(key, 'count', quota.message_count or 0)
+    pipe.hsetnx(key, 'plan', quota.plan or 'free')
+    pipe.expire(key, QUOTA_COUNTER_TTL)
+    pipe.execute()
+
+def consume_quota(user_id, session):
+    if redis_client:
+        current_month = time.strftime("%Y-%m")
+        keys = [quota_counter_key(user_id, current_month), 'quota:dirty']
+        try:
+            script = get_quota_script(redis_client)
+            count, plan = script(keys=keys, args=[FREE_PLAN_MESSAGE_LIMIT])
+            if int(count) == -1:
+                seed_quota_counter(user_id, current_month, session)
+                count, plan = script(keys=keys, args=[FREE_PLAN_MESSAGE_LIMIT])
+            count = int(count)
+            if count == 0:
+                return False
+            if plan == 'free' and 75 < count <= FREE_PLAN_MESSAGE_LIMIT:
+                logger.info(f"Usuario {user_id} ha usado {count - 1} mensajes. Notificando...")
+            return True
+        except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+            logger.warning(f"Error en contador de cuota en Redis: {str(e)}. Usando la base de datos.")
+
+    if not check_quota(user_id, session):
+        return False
+    increment_quota(user_id, session)
+    return True
+
+@celery_app.task
+def flush_quota_counters(batch_size=500):
+    if not redis_client:
+        return 0
+    flushed = 0
+    while True:
+        keys = redis_client.spop('quota:dirty', batch_size)
+        if not keys:
+            break
+        try:
+            flushed += flush_quota_batch(keys)
+        except Exception:
+            # Sin commit los contadores siguen pendientes: se devuelven al set para el próximo volcado
+            redis_client.sadd('quota:dirty', *keys)
+            raise
+    if flushed:
+        logger.info(f"Contadores de cuota volcados a la base de datos: {flushed}")
+    return flushed
+
+def flush_quota_batch(keys):
+    pipe = redis_client.pipeline(transaction=False)
+    for key in keys:
+        pipe.hget(key, 'count')
+    counts = {}
+    for key, count in zip(keys, pipe.execute()):
+        if count is not None:
+            _, user_id, month = key.split(':', 2)
+            counts[(int(user_id), month)] = (key, int(count))
+    if not counts:
+        return 0
+
+    with get_session() as session:
+        # Una sola consulta por lote; el filtro por separado puede traer alguna fila de más
+        quotas = {
+            (quota.user_id, quota.month): quota
+            for quota in session.query(MessageQuota).filter(
+                MessageQuota.user_id.in_({user_id for user_id, _ in counts}),
+                MessageQuota.month.in_({month for _, month in counts})
+            )
+        }
+        plans = {}
+        for (user_id, month), (key, count) in counts.items():
+            quota = quotas.get((user_id, month))
+            if not quota:
+                quota = MessageQuota(user_id=user_id, month=month)
+                session.add(quota)
+            # Valor absoluto: volver a aplicar el mismo contador es inocuo
+            quota.message_count = count
+            if quota.plan:
+                plans[key] = quota.plan
+        session.commit()
+
+    if plans:
+        pipe = redis_client.pipeline(transaction=False)
+        for key, plan in plans.items():
+            pipe.hset(key, 'plan', plan)
+        pipe.execute()
+    return len(counts)
+
+celery_app.conf.beat_schedule = {
+    'flush-quota-counters': {
+        'task': flush_quota_counters.name,
+        'schedule': QUOTA_FLUSH_INTERVAL
+    },
+    'refresh-twilio-numbers': {
+        'task': refresh_twilio_numbers.name,
+        'schedule': TWILIO_NUMBERS_REFRESH_INTERVAL
+    }
+}
+
 def parse_menu_to_flows(menu_json):
     try:
         if isinstance(menu_json, str):
@@ -466,107 +1134,231 @@ def parse_menu_to_flows(menu_json):
         logger.error(f"Error inesperado al procesar menú: {str(e)}")
         return []
 
-def load_initial_templates():
-    with get_session() as session:
-        expected_templates = [
-            {
-                "name": "Ventas Tienda Online",
-                "tone": "amigable",
-                "purpose": "vender productos y responder preguntas",
-                "description": "Ideal para tiendas online. Incluye flujos para saludar, mostrar catálogo y tomar pedidos.",
-                "flows": json.dumps([
-                    {"user_message": "hola", "bot_response": "¡Hola! Bienvenid@ a mi tienda. ¿Qué te gustaría comprar hoy? 😊"},
-                    {"user_message": "precio", "bot_response": "Dime qué producto te interesa y te doy el precio al instante. 💰"}
-                ])
-            },
-            {
-                "name": "Soporte Técnico",
-                "tone": "profesional",
-                "purpose": "resolver problemas técnicos",
-                "description": "Perfecto para empresas de tecnología. Ayuda a resolver problemas técnicos paso a paso.",
-                "flows": json.dumps([
-                    {"user_message": "tengo un problema", "bot_response": "Describe tu problema y te ayudaré paso a paso."},
-                    {"user_message": "no funciona", "bot_response": "¿Puedes dar más detalles? Estoy aquí para solucionarlo."}
-                ])
-            },
-            {
-                "name": "Reservas de Restaurante",
-                "tone": "amigable",
-                "purpose": "gestionar reservas y responder consultas",
-                "description": "Diseñado para restaurantes. Gestiona reservas y responde preguntas sobre el menú.",
-                "flows": json.dumps([
-                    {"user_message": "hola", "bot_response": "¡Hola! Bienvenid@ a nuestro restaurante. ¿Quieres reservar una mesa? 🍽️"},
-                    {"user_message": "reservar", "bot_response": "Claro, dime para cuántas personas y a qué hora. ¡Te ayudo en un segundo!"},
-                    {"user_message": "menú", "bot_response": "Tenemos platos deliciosos: pasta, carnes y postres. ¿Te envío el menú completo?"}
-                ])
-            },
-            {
-                "name": "Atención al Cliente - Ecommerce",
-                "tone": "profesional",
-                "purpose": "gestionar pedidos y devoluciones",
-                "description": "Para tiendas online grandes. Gestiona pedidos, devoluciones y dudas frecuentes.",
-                "flows": json.dumps([
-                    {"user_message": "estado de mi pedido", "bot_response": "Por favor, dame tu número de pedido y lo verifico de inmediato."},
-                    {"user_message": "devolver producto", "bot_response": "Claro, indícame el producto y el motivo. Te guiaré en el proceso de devolución."},
-                    {"user_message": "hola", "bot_response": "Hola, gracias por contactarnos. ¿En qué puedo ayudarte hoy?"}
-                ])
-            },
-            {
-                "name": "Promoción de Servicios",
-                "tone": "divertido",
-                "purpose": "promocionar servicios y captar clientes",
-                "description": "Para freelancers y agencias. Promociona servicios con un tono alegre y atractivo.",
-                "flows": json.dumps([
-                    {"user_message": "hola", "bot_response": "¡Hey, hola! ¿List@ para descubrir algo genial? Ofrecemos servicios que te van a encantar. 🎉"},
-                    {"user_message": "qué ofreces", "bot_response": "Desde diseño épico hasta soluciones locas. ¿Qué necesitas? ¡Te lo cuento todo!"},
-                    {"user_message": "precio", "bot_response": "Los precios son tan buenos que te van a hacer saltar de emoción. ¿Qué servicio te interesa?"}
-                ])
-            },
-            {
-                "name": "Asistente de Eventos",
-                "tone": "amigable",
-                "purpose": "gestionar invitaciones y detalles de eventos",
-                "description": "Para organizadores de eventos. Gestiona invitaciones y responde dudas sobre fechas y lugares.",
-                "flows": json.dumps([
-                    {"user_message": "hola", "bot_response": "¡Hola! ¿Vienes a nuestro próximo evento? Te cuento todo lo que necesitas saber. 🎈"},
-                    {"user_message": "cuándo es", "bot_response": "Dime qué evento te interesa y te paso la fecha y hora exactas."},
-                    {"user_message": "registrarme", "bot_response": "¡Genial! Dame tu nombre y te apunto en la lista. ¿Algo más que quieras saber?"}
-                ])
-            },
-            {
-                "name": "Soporte de Suscripciones",
-                "tone": "serio",
-                "purpose": "gestionar suscripciones y pagos",
-                "description": "Para servicios de suscripción. Gestiona cancelaciones y problemas de pago con profesionalismo.",
-                "flows": json.dumps([
-                    {"user_message": "cancelar suscripción", "bot_response": "Lamento que quieras cancelar. Por favor, indícame tu ID de suscripción para proceder."},
-                    {"user_message": "pago fallido", "bot_response": "Verifiquemos eso. Proporcióname tu correo o número de suscripción y lo solucionamos."},
-                    {"user_message": "hola", "bot_response": "Buenos días, estoy aquí para ayudarte con tu suscripción. ¿En qué puedo asistirte?"}
-                ])
-            }
+# Índice compilado de flujos por chatbot, guardado en el namespace flows:<id> de app_cache
+FLOW_INDEX_TTL = int(os.getenv('FLOW_INDEX_TTL', 86400))
+# Nodo actual de cada conversación guiada (flow_cursor:<chatbot>:<usuario>)
+FLOW_CURSOR_TTL = int(os.getenv('FLOW_CURSOR_TTL', 1800))
+
+def normalize_message(text):
+    return " ".join((text or "").lower().split())
+
+def compile_flow_index(session, chatbot_id):
+    flows = session.query(Flow.id, Flow.user_message, Flow.bot_response).filter_by(chatbot_id=chatbot_id).order_by(Flow.position.asc()).all()
+    compiled = {'flows': {}, 'index': {}, 'edges': {}}
+    for flow in flows:
+        flow_id = str(flow.id)
+        compiled['flows'][flow_id] = flow.bot_response
+        # Ante mensajes duplicados gana el de menor posición, igual que el recorrido lineal anterior
+        compiled['index'].setdefault(normalize_message(flow.user_message), flow_id)
+
+    # Transiciones salientes de cada nodo: se activan con la condición del edge o, si está vacía,
+    # con el mensaje de usuario del flujo destino
+    edges = session.query(FlowEdge.source_flow_id, FlowEdge.target_flow_id, FlowEdge.condition).filter_by(chatbot_id=chatbot_id).all()
+    flow_messages = {str(flow.id): flow.user_message for flow in flows}
+    for edge in edges:
+        source_id, target_id = str(edge.source_flow_id), str(edge.target_flow_id)
+        if target_id not in flow_messages:
+            continue
+        trigger = normalize_message(edge.condition) or normalize_message(flow_messages[target_id])
+        compiled['edges'].setdefault(source_id, {}).setdefault(trigger, target_id)
+    return compiled
+
+def get_flow_index(chatbot_id):
+    compiled = app_cache.get(f"flows:{chatbot_id}", 'index')
+    if compiled is None:
+        with get_session() as session:
+            compiled = compile_flow_index(session, chatbot_id)
+        app_cache.set(f"flows:{chatbot_id}", 'index', compiled, ttl=FLOW_INDEX_TTL)
+    return compiled
+
+def rebuild_flow_index(chatbot_id, session):
+    app_cache.invalidate(f"flows:{chatbot_id}")
+    compiled = compile_flow_index(session, chatbot_id)
+    app_cache.set(f"flows:{chatbot_id}", 'index', compiled, ttl=FLOW_INDEX_TTL)
+    logger.info(f"Índice de flujos del chatbot {chatbot_id} recompilado ({len(compiled['index'])} entradas)")
+    return compiled
+
+def invalidate_flow_index(chatbot_id):
+    app_cache.invalidate(f"flows:{chatbot_id}")
+
+def get_flow_cursor(chatbot_id, user_id):
+    if not redis_client:
+        return None
+    try:
+        return redis_client.get(f"flow_cursor:{chatbot_id}:{user_id}")
+    except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+        logger.warning(f"Error al leer cursor de flujo: {str(e)}. Continuando sin estado.")
+        return None
+
+def set_flow_cursor(chatbot_id, user_id, flow_id):
+    if not redis_client:
+        return
+    try:
+        redis_client.setex(f"flow_cursor:{chatbot_id}:{user_id}", FLOW_CURSOR_TTL, flow_id)
+    except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+        logger.warning(f"Error al guardar cursor de flujo: {str(e)}. Continuando sin estado.")
+
+def match_flow(chatbot_id, user_message, user_id=None):
+    compiled = get_flow_index(chatbot_id)
+    key = normalize_message(user_message)
+    flow_id = None
+
+    # Primero solo las transiciones del nodo donde quedó la conversación
+    if user_id is not None:
+        cursor = get_flow_cursor(chatbot_id, user_id)
+        if cursor:
+            flow_id = compiled['edges'].get(cursor, {}).get(key)
+    if flow_id is None:
+        flow_id = compiled['index'].get(key)
+    if flow_id is None:
+        return None
+
+    if user_id is not None:
+        set_flow_cursor(chatbot_id, user_id, flow_id)
+    return compiled['flows'][flow_id]
+
+# Plantillas iniciales. Se siembran en la base de datos al desplegar (python migrations.py upgrade)
+# y solo cuando cambia su hash de contenido; ver sync_templates y migrations.seed_templates.
+TEMPLATE_DEFINITIONS = [
+    {
+        "name": "Ventas Tienda Online",
+        "tone": "amigable",
+        "purpose": "vender productos y responder preguntas",
+        "description": "Ideal para tiendas online. Incluye flujos para saludar, mostrar catálogo y tomar pedidos.",
+        "flows": [
+            {"user_message": "hola", "bot_response": "¡Hola! Bienvenid@ a mi tienda. ¿Qué te gustaría comprar hoy? 😊"},
+            {"user_message": "precio", "bot_response": "Dime qué producto te interesa y te doy el precio al instante. 💰"}
         ]
-
-        for template_data in expected_templates:
-            template = session.query(Template).filter_by(name=template_data["name"]).first()
-            if not template:
-                new_template = Template(
-                    name=template_data["name"],
-                    tone=template_data["tone"],
-                    purpose=template_data["purpose"],
-                    flows=template_data["flows"],
-                    description=template_data["description"]
-                )
-                session.add(new_template)
-                logger.info(f"Plantilla '{template_data['name']}' creada.")
-            else:
-                template.tone = template_data["tone"]
-                template.purpose = template_data["purpose"]
-                template.flows = template_data["flows"]
-                template.description = template_data["description"]
-                logger.info(f"Plantilla '{template_data['name']}' actualizada.")
-
-        session.commit()
-        logger.info("Verificación y carga de plantillas completada.")
+    },
+    {
+        "name": "Soporte Técnico",
+        "tone": "profesional",
+        "purpose": "resolver problemas técnicos",
+        "description": "Perfecto para empresas de tecnología. Ayuda a resolver problemas técnicos paso a paso.",
+        "flows": [
+            {"user_message": "tengo un problema", "bot_response": "Describe tu problema y te ayudaré paso a paso."},
+            {"user_message": "no funciona", "bot_response": "¿Puedes dar más detalles? Estoy aquí para solucionarlo."}
+        ]
+    },
+    {
+        "name": "Reservas de Restaurante",
+        "tone": "amigable",
+        "purpose": "gestionar reservas y responder consultas",
+        "description": "Diseñado para restaurantes. Gestiona reservas y responde preguntas sobre el menú.",
+        "flows": [
+            {"user_message": "hola", "bot_response": "¡Hola! Bienvenid@ a nuestro restaurante. ¿Quieres reservar una mesa? 🍽️"},
+            {"user_message": "reservar", "bot_response": "Claro, dime para cuántas personas y a qué hora. ¡Te ayudo en un segundo!"},
+            {"user_message": "menú", "bot_response": "Tenemos platos deliciosos: pasta, carnes y postres. ¿Te envío el menú completo?"}
+        ]
+    },
+    {
+        "name": "Atención al Cliente - Ecommerce",
+        "tone": "profesional",
+        "purpose": "gestionar pedidos y devoluciones",
+        "description": "Para tiendas online grandes. Gestiona pedidos, devoluciones y dudas frecuentes.",
+        "flows": [
+            {"user_message": "estado de mi pedido", "bot_response": "Por favor, dame tu número de pedido y lo verifico de inmediato."},
+            {"user_message": "devolver producto", "bot_response": "Claro, indícame el producto y el motivo. Te guiaré en el proceso de devolución."},
+            {"user_message": "hola", "bot_response": "Hola, gracias por contactarnos. ¿En qué puedo ayudarte hoy?"}
+        ]
+    },
+    {
+        "name": "Promoción de Servicios",
+        "tone": "divertido",
+        "purpose": "promocionar servicios y captar clientes",
+        "description": "Para freelancers y agencias. Promociona servicios con un tono alegre y atractivo.",
+        "flows": [
+            {"user_message": "hola", "bot_response": "¡Hey, hola! ¿List@ para descubrir algo genial? Ofrecemos servicios que te van a encantar. 🎉"},
+            {"user_message": "qué ofreces", "bot_response": "Desde diseño épico hasta soluciones locas. ¿Qué necesitas? ¡Te lo cuento todo!"},
+            {"user_message": "precio", "bot_response": "Los precios son tan buenos que te van a hacer saltar de emoción. ¿Qué servicio te interesa?"}
+        ]
+    },
+    {
+        "name": "Asistente de Eventos",
+        "tone": "amigable",
+        "purpose": "gestionar invitaciones y detalles de eventos",
+        "description": "Para organizadores de eventos. Gestiona invitaciones y responde dudas sobre fechas y lugares.",
+        "flows": [
+            {"user_message": "hola", "bot_response": "¡Hola! ¿Vienes a nuestro próximo evento? Te cuento todo lo que necesitas saber. 🎈"},
+            {"user_message": "cuándo es", "bot_response": "Dime qué evento te interesa y te paso la fecha y hora exactas."},
+            {"user_message": "registrarme", "bot_response": "¡Genial! Dame tu nombre y te apunto en la lista. ¿Algo más que quieras saber?"}
+        ]
+    },
+    {
+        "name": "Soporte de Suscripciones",
+        "tone": "serio",
+        "purpose": "gestionar suscripciones y pagos",
+        "description": "Para servicios de suscripción. Gestiona cancelaciones y problemas de pago con profesionalismo.",
+        "flows": [
+            {"user_message": "cancelar suscripción", "bot_response": "Lamento que quieras cancelar. Por favor, indícame tu ID de suscripción para proceder."},
+            {"user_message": "pago fallido", "bot_response": "Verifiquemos eso. Proporcióname tu correo o número de suscripción y lo solucionamos."},
+            {"user_message": "hola", "bot_response": "Buenos días, estoy aquí para ayudarte con tu suscripción. ¿En qué puedo asistirte?"}
+        ]
+    }
+]
+
+def templates_digest():
+    payload = json.dumps(TEMPLATE_DEFINITIONS, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def sync_templates(conn):
+    # Una sola consulta para las existentes y escrituras solo de las que cambiaron
+    table = Template.__table__
+    existing = {row.name: row for row in conn.execute(select(table))}
+    created = updated = 0
+    for definition in TEMPLATE_DEFINITIONS:
+        values = dict(definition, flows=json.dumps(definition['flows']))
+        row = existing.get(values['name'])
+        if row is None:
+            conn.execute(insert(table).values(**values))
+            created += 1
+        elif any(getattr(row, field) != value for field, value in values.items()):
+            conn.execute(update(table).where(table.c.id == row.id).values(**values))
+            updated += 1
+    logger.info(f"Plantillas sincronizadas: {created} creadas, {updated} actualizadas")
+    invalidate_templates_payload()
+    return created + updated
+
+# Listado de /api/templates ya serializado, con su ETag. Las plantillas solo cambian al
+# desplegar, así que basta una copia por proceso que se renueva cada TEMPLATES_CACHE_TTL segundos.
+TEMPLATES_CACHE_TTL = float(os.getenv('TEMPLATES_CACHE_TTL', 300))
+_templates_payload = None
+_templates_payload_lock = threading.Lock()
+
+def invalidate_templates_payload():
+    global _templates_payload
+    _templates_payload = None
+
+def get_templates_payload():
+    global _templates_payload
+    payload = _templates_payload
+    if payload and payload['expires_at'] > time.monotonic():
+        return payload
+    with _templates_payload_lock:
+        payload = _templates_payload
+        if payload and payload['expires_at'] > time.monotonic():
+            return payload
+        with get_session() as session:
+            templates = session.query(Template).order_by(Template.id).all()
+            body = json.dumps({
+                'templates': [
+                    {
+                        'id': t.id,
+                        'name': t.name,
+                        'description': t.description,
+                        'tone': t.tone,
+                        'purpose': t.purpose,
+                        'flows': json.loads(t.flows)
+                    } for t in templates
+                ]
+            }, ensure_ascii=False).encode('utf-8')
+        payload = {
+            'body': body,
+            'etag': f"templates-{hashlib.sha256(body).hexdigest()[:16]}",
+            'expires_at': time.monotonic() + TEMPLATES_CACHE_TTL
+        }
+        _templates_payload = payload
+        return payload
 
 @app.route('/api/templates', methods=['GET', 'OPTIONS'])
 @jwt_required()
@@ -574,22 +1366,13 @@ def get_templates():
     if request.method == 'OPTIONS':
         return jsonify({'message': 'Preflight OK'}), 200
 
-    logger.info(f"Solicitud recibida en /api/templates. Headers: {request.headers}")
-    logger.info(f"Cookies: {request.cookies}")
-    with get_session() as session:
-        templates = session.query(Template).all()
-        return jsonify({
-            'templates': [
-                {
-                    'id': t.id,
-                    'name': t.name,
-                    'description': t.description,
-                    'tone': t.tone,
-                    'purpose': t.purpose,
-                    'flows': json.loads(t.flows)
-                } for t in templates
-            ]
-        })
+    payload = get_templates_payload()
+    if request.if_none_match.contains(payload['etag']):
+        response = Response(status=304)
+    else:
+        response = Response(payload['body'], mimetype='application/json')
+    response.set_etag(payload['etag'])
+    return response
 
 # Rutas de autenticación
 @app.route('/register', methods=['GET', 'POST'])
@@ -919,33 +1702,25 @@ def grok_api():
     messages = [
         {"role": "system", "content": "Eres Plubot de Plubot Web. Responde amigable, breve y con tono alegre (máx. 2-3 frases). Usa emojis si aplica."}
     ] + history + [{"role": "user", "content": user_message}]
-    max_retries = 3
-    for attempt in range(max_retries):
-        try:
-            response = requests.post("https://api.x.ai/v1/chat/completions", json={
-                "model": "grok-2-1212", "messages": messages, "temperature": 0.5, "max_tokens": 50
-            }, headers={"Authorization": f"Bearer {XAI_API_KEY}", "Content-Type": "application/json"}, timeout=10)
-            response.raise_for_status()
-            grok_response = response.json()
-            message = grok_response['choices'][0]['message']['content']
-            logger.info(f"Respuesta de Grok en /api/grok: {message}")
-            return jsonify({'response': message})
-        except HTTPError as e:
-            if e.response.status_code == 429 and attempt < max_retries - 1:
-                time.sleep(2 ** attempt)
-                continue
-            logger.exception(f"Error en /api/grok: {str(e)}")
-            return jsonify({'error': f"Error al conectar con Grok: {str(e)}"}), 500
-        except Exception as e:
-            logger.exception(f"Error en /api/grok: {str(e)}")
-            return jsonify({'error': f"Error: {str(e)}"}), 500
+    if not xai_rate_limiter.acquire(timeout=XAI_RATE_LIMIT_WAIT):
+        return jsonify({'error': 'Demasiadas solicitudes. Espera un momento y vuelve a intentarlo.'}), 429
+    try:
+        # Los reintentos ante 429 los hace llm_client dentro del presupuesto de la ruta 'api'
+        message = llm_client.complete(messages, max_tokens=50, route='api')
+        logger.info(f"Respuesta de Grok en /api/grok: {message}")
+        return jsonify({'response': message})
+    except HTTPError as e:
+        logger.exception(f"Error en /api/grok: {str(e)}")
+        return jsonify({'error': f"Error al conectar con Grok: {str(e)}"}), 500
+    except Exception as e:
+        logger.exception(f"Error en /api/grok: {str(e)}")
+        return jsonify({'error': f"Error: {str(e)}"}), 500
 
 # Rutas del creador de chatbots
 @app.route('/create', methods=['GET', 'POST'])
 @jwt_required()
 def create_page():
     logger.info("Entrando en create_page")
-    load_initial_templates()
     user_id = get_jwt_identity()
     logger.info(f"Acceso a /create por usuario ID: {user_id}")
     logger.info(f"Headers: {request.headers}")
@@ -997,16 +1772,9 @@ def create_chatbot(name, tone, purpose, whatsapp_number=None, business_info=None
         menu_flows = parse_menu_to_flows(menu_json)
         flows_to_save = flows_to_save + menu_flows if flows_to_save else menu_flows
 
-    system_message = f"Eres un chatbot {tone} llamado '{name}'. Tu propósito es {purpose}. Usa un tono {tone} y gramática correcta."
-    if business_info:
-        system_message += f"\nNegocio: {business_info}"
-    if pdf_url:
-        system_message += "\nContenido del PDF será añadido tras procesar."
-    messages = [
-        {"role": "system", "content": system_message},
-        {"role": "user", "content": "Dame un mensaje de bienvenida."}
-    ]
-    initial_message = call_grok(messages, max_tokens=100)
+    # El LLM no se llama aquí: sin bienvenida en caché se guarda una provisional y se genera en segundo plano
+    cached_welcome = app_cache.get('welcome', welcome_cache_key(name, tone, purpose, business_info))
+    initial_message = cached_welcome or welcome_placeholder(name)
 
     chatbot = Chatbot(
         name=name, tone=tone, purpose=purpose, initial_message=initial_message,
@@ -1014,45 +1782,27 @@ def create_chatbot(name, tone, purpose, whatsapp_number=None, business_info=None
         image_url=image_url, user_id=user_id
     )
     session.add(chatbot)
-    session.commit()
+    session.flush()
     chatbot_id = chatbot.id
-
-    if pdf_url:
-        process_pdf_async.delay(chatbot_id, pdf_url)
-
-    # Mapear los flujos a sus IDs para asociar los edges
-    flow_id_map = {}
-    if flows_to_save:
-        for index, flow in enumerate(flows_to_save):
-            if flow.get('user_message') and flow.get('bot_response'):
-                intent = flow.get('intent', 'general')
-                condition = flow.get('condition', '')
-                flow_entry = Flow(
-                    chatbot_id=chatbot_id,
-                    user_message=flow['user_message'],
-                    bot_response=flow['bot_response'],
-                    position=index,
-                    intent=intent,
-                    condition=condition
-                )
-                session.add(flow_entry)
-                session.flush()  # Para obtener el ID del flow
-                flow_id_map[str(index)] = flow_entry.id
-
-    # Guardar los edges
-    for edge in edges_to_save:
-        source_id = flow_id_map.get(edge.get('source'))
-        target_id = flow_id_map.get(edge.get('target'))
-        if source_id and target_id:
-            edge_entry = FlowEdge(
-                chatbot_id=chatbot_id,
-                source_flow_id=source_id,
-                target_flow_id=target_id,
-                condition=""
-            )
-            session.add(edge_entry)
-
+    save_flows_and_edges(session, chatbot_id, flows_to_save, edges_to_save)
     session.commit()
+    rebuild_flow_index(chatbot_id, session)
+    invalidate_bot_list(user_id)
+    if whatsapp_number:
+        set_whatsapp_route(whatsapp_number, chatbot_id)
+
+    if not cached_welcome:
+        # El chatbot ya existe y el mensaje provisional es válido: un broker caído no debe
+        # convertir la creación en un error (el cliente reintentaría y duplicaría el chatbot)
+        try:
+            generate_welcome_message.delay(chatbot_id)
+        except Exception as e:
+            logger.exception(f"No se pudo encolar el mensaje de bienvenida del chatbot {chatbot_id}: {str(e)}")
+    if pdf_url:
+        try:
+            process_pdf_async.delay(chatbot_id, pdf_url)
+        except Exception as e:
+            logger.exception(f"No se pudo encolar el procesamiento del PDF del chatbot {chatbot_id}: {str(e)}")
     return f"Chatbot '{name}' creado con éxito. ID: {chatbot_id}. Mensaje inicial: {initial_message}"
 
 @app.route('/create-bot', methods=['OPTIONS', 'POST', 'GET'])
@@ -1088,35 +1838,9 @@ def create_bot():
     if not name:
         return jsonify({'status': 'error', 'message': 'El nombre del chatbot es obligatorio'}), 400
 
-    flows = []
-    user_messages = set()
-    for index, flow in enumerate(flows_raw):
-        try:
-            validated_flow = FlowModel(**flow)
-            user_msg = validated_flow.user_message.strip().lower()
-            bot_resp = validated_flow.bot_response.strip()
-
-            if not user_msg or not bot_resp:
-                return jsonify({
-                    'status': 'error',
-                    'message': f'El flujo en la posición {index} tiene mensajes vacíos. Tanto el mensaje del usuario como la respuesta del bot deben estar llenos.'
-                }), 400
-
-            if user_msg in user_messages:
-                return jsonify({
-                    'status': 'error',
-                    'message': f'El mensaje de usuario "{user_msg}" en la posición {index} está duplicado en los flujos.'
-                }), 400
-
-            user_messages.add(user_msg)
-            flows.append(validated_flow.dict())
-
-        except ValidationError as e:
-            logger.warning(f"Flujo inválido en posición {index}: {flow}. Error: {str(e)}")
-            return jsonify({
-                'status': 'error',
-                'message': f'Flujo inválido en la posición {index}: {str(e)}'
-            }), 400
+    flows, error = validate_flows(flows_raw)
+    if error:
+        return jsonify({'status': 'error', 'message': error}), 400
 
     with get_session() as session:
         try:
@@ -1131,34 +1855,6 @@ def create_bot():
             logger.exception(f"Error al crear chatbot: {str(e)}")
             return jsonify({'status': 'error', 'message': f'Error al crear el chatbot: {str(e)}'}), 500
 
-@app.route('/list-bots', methods=['GET', 'OPTIONS'])
-@jwt_required()
-def list_bots():
-    if request.method == 'OPTIONS':
-        return jsonify({'message': 'Preflight OK'}), 200
-
-    logger.info(f"Solicitud recibida en /list-bots. Headers: {request.headers}")
-    logger.info(f"Cookies: {request.cookies}")
-
-    user_id = get_jwt_identity()
-    logger.info(f"[DEBUG] Usuario autenticado: {user_id}")
-    with get_session() as session:
-        chatbots = session.query(Chatbot).filter_by(user_id=user_id).all()
-        chatbots_data = [
-            {
-                'id': bot.id,
-                'name': bot.name,
-                'tone': bot.tone,
-                'purpose': bot.purpose,
-                'whatsapp_number': bot.whatsapp_number,
-                'initial_message': bot.initial_message,
-                'business_info': bot.business_info,
-                'pdf_url': bot.pdf_url,
-                'image_url': bot.image_url
-            } for bot in chatbots
-        ]
-        return jsonify({'chatbots': chatbots_data})
-
 @app.route('/update-bot/<int:chatbot_id>', methods=['PUT', 'OPTIONS'])
 @jwt_required()
 def update_bot(chatbot_id):
@@ -1184,40 +1880,23 @@ def update_bot(chatbot_id):
     edges_raw = data.get('edges', [])  # Nuevo campo para los edges
     template_id = data.get('template_id')
     menu_json = data.get('menu_json')
+    prompt_token_budget = data.get('prompt_token_budget')
 
     if not name:
         return jsonify({'status': 'error', 'message': 'El nombre del chatbot es obligatorio'}), 400
+    if prompt_token_budget is not None and (not isinstance(prompt_token_budget, int) or prompt_token_budget < PROMPT_MIN_TOKEN_BUDGET):
+        return jsonify({'status': 'error', 'message': f'prompt_token_budget debe ser un entero mayor o igual a {PROMPT_MIN_TOKEN_BUDGET}'}), 400
 
-    flows = []
-    user_messages = set()
-    for index, flow in enumerate(flows_raw):
-        try:
-            validated_flow = FlowModel(**flow)
-            user_msg = validated_flow.user_message.lower()
-            if not user_msg or not validated_flow.bot_response:
-                return jsonify({
-                    'status': 'error',
-                    'message': f'El flujo en la posición {index} tiene mensajes vacíos. Tanto el mensaje del usuario como la respuesta del bot deben estar llenos.'
-                }), 400
-            if user_msg in user_messages:
-                return jsonify({
-                    'status': 'error',
-                    'message': f'El mensaje de usuario "{user_msg}" en la posición {index} está duplicado.'
-                }), 400
-            user_messages.add(user_msg)
-            flows.append(validated_flow.dict())
-        except ValidationError as e:
-            logger.warning(f"Flujo inválido en posición {index}: {flow}. Error: {str(e)}")
-            return jsonify({
-                'status': 'error',
-                'message': f'Flujo inválido en la posición {index}: {str(e)}'
-            }), 400
+    flows, error = validate_flows(flows_raw)
+    if error:
+        return jsonify({'status': 'error', 'message': error}), 400
 
     with get_session() as session:
         chatbot = session.query(Chatbot).filter_by(id=chatbot_id, user_id=user_id).first()
         if not chatbot:
             return jsonify({'status': 'error', 'message': 'Chatbot no encontrado o no tienes permisos'}), 404
 
+        old_number = chatbot.whatsapp_number
         chatbot.name = name
         if tone:
             chatbot.tone = tone
@@ -1231,6 +1910,8 @@ def update_bot(chatbot_id):
             chatbot.pdf_url = pdf_url
         if image_url is not None:
             chatbot.image_url = image_url
+        if prompt_token_budget is not None:
+            chatbot.prompt_token_budget = prompt_token_budget
 
         if template_id:
             template = session.query(Template).filter_by(id=template_id).first()
@@ -1249,38 +1930,21 @@ def update_bot(chatbot_id):
         session.query(Flow).filter_by(chatbot_id=chatbot_id).delete()
         session.query(FlowEdge).filter_by(chatbot_id=chatbot_id).delete()
 
-        # Mapear los nuevos flujos a sus IDs
-        flow_id_map = {}
-        for index, flow in enumerate(flows):
-            if flow.get('user_message') and flow.get('bot_response'):
-                intent = flow.get('intent', 'general')
-                condition = flow.get('condition', '')
-                flow_entry = Flow(
-                    chatbot_id=chatbot_id,
-                    user_message=flow['user_message'],
-                    bot_response=flow['bot_response'],
-                    position=index,
-                    intent=intent,
-                    condition=condition
-                )
-                session.add(flow_entry)
-                session.flush()
-                flow_id_map[str(index)] = flow_entry.id
-
-        # Guardar los nuevos edges
-        for edge in edges_raw:
-            source_id = flow_id_map.get(edge.get('source'))
-            target_id = flow_id_map.get(edge.get('target'))
-            if source_id and target_id:
-                edge_entry = FlowEdge(
-                    chatbot_id=chatbot_id,
-                    source_flow_id=source_id,
-                    target_flow_id=target_id,
-                    condition=""
-                )
-                session.add(edge_entry)
-
+        save_flows_and_edges(session, chatbot_id, flows, edges_raw)
+        chatbot.version = (chatbot.version or 1) + 1
         session.commit()
+        app_cache.invalidate(f"chatbot:{chatbot_id}")
+        invalidate_bot_list(user_id)
+        if chatbot.whatsapp_number != old_number:
+            set_whatsapp_route(chatbot.whatsapp_number, chatbot_id, old_number)
+        rebuild_flow_index(chatbot_id, session)
+        if pdf_url:
+            # Si el PDF no cambió, la tarea se resuelve con un GET condicional; los cambios ya están
+            # guardados, así que un broker caído no debe devolver un error
+            try:
+                process_pdf_async.delay(chatbot_id, pdf_url)
+            except Exception as e:
+                logger.exception(f"No se pudo encolar el procesamiento del PDF del chatbot {chatbot_id}: {str(e)}")
         return jsonify({'status': 'success', 'message': f"Chatbot '{name}' actualizado con éxito."}), 200
 
 @app.route('/delete-bot/<int:chatbot_id>', methods=['DELETE'])
@@ -1292,13 +1956,187 @@ def delete_bot(chatbot_id):
         if not chatbot:
             return jsonify({'status': 'error', 'message': 'Chatbot no encontrado o no tienes permisos'}), 404
 
+        # Los mensajes aún en cola no deben insertarse después de borrar el chatbot
+        conversation_writer.discard(lambda row: row['chatbot_id'] == chatbot_id)
         session.query(Flow).filter_by(chatbot_id=chatbot_id).delete()
         session.query(FlowEdge).filter_by(chatbot_id=chatbot_id).delete()
         session.query(Conversation).filter_by(chatbot_id=chatbot_id).delete()
+        whatsapp_number = chatbot.whatsapp_number
         session.delete(chatbot)
         session.commit()
+        app_cache.invalidate(f"chatbot:{chatbot_id}")
+        invalidate_bot_list(user_id)
+        remove_whatsapp_route(whatsapp_number)
+        invalidate_flow_index(chatbot_id)
         return jsonify({'status': 'success', 'message': f"Chatbot '{chatbot.name}' eliminado con éxito."}), 200
 
+def serialize_flow(flow):
+    return {
+        'id': flow.id,
+        'user_message': flow.user_message,
+        'bot_response': flow.bot_response,
+        'position': flow.position,
+        'intent': flow.intent,
+        'condition': flow.condition
+    }
+
+def serialize_edge(edge):
+    return {'id': edge.id, 'source': edge.source_flow_id, 'target': edge.target_flow_id, 'condition': edge.condition}
+
+def apply_flow_delta(session, chatbot, delta):
+    """Aplica un FlowPatchModel sobre los flujos del chatbot. Devuelve (refs -> id, None) o (None, error)."""
+    chatbot_id = chatbot.id
+    existing = {
+        flow.id: flow for flow in session.query(
+            Flow.id, Flow.user_message, Flow.position
+        ).filter_by(chatbot_id=chatbot_id)
+    }
+    flow_ids = {change.id for change in delta.flows.update} | set(delta.flows.remove)
+    unknown = flow_ids - existing.keys()
+    if unknown:
+        return None, f"Flujos no encontrados en este chatbot: {sorted(unknown)}"
+    edge_ids = {change.id for change in delta.edges.update} | set(delta.edges.remove)
+    if edge_ids:
+        found = {row.id for row in session.query(FlowEdge.id).filter(FlowEdge.chatbot_id == chatbot_id, FlowEdge.id.in_(edge_ids))}
+        if edge_ids - found:
+            return None, f"Edges no encontrados en este chatbot: {sorted(edge_ids - found)}"
+
+    # Mismas reglas que validate_flows: ni el mensaje del usuario ni la respuesta del bot pueden quedar vacíos
+    empty_message = "tiene mensajes vacíos. Tanto el mensaje del usuario como la respuesta del bot deben estar llenos."
+    for index, flow in enumerate(delta.flows.add):
+        if not flow.bot_response.strip():
+            return None, f"El flujo nuevo en la posición {index} {empty_message}"
+    for change in delta.flows.update:
+        if change.bot_response is not None and not change.bot_response.strip():
+            return None, f"El flujo {change.id} {empty_message}"
+
+    # Mensajes de usuario tras aplicar el cambio, normalizados como en el índice de flujos
+    removed = set(delta.flows.remove)
+    messages = {flow_id: flow.user_message for flow_id, flow in existing.items() if flow_id not in removed}
+    for change in delta.flows.update:
+        if change.user_message is not None:
+            messages[change.id] = change.user_message
+    final_messages = list(messages.values()) + [flow.user_message for flow in delta.flows.add]
+    normalized = [normalize_message(message) for message in final_messages]
+    if any(not message for message in normalized):
+        return None, "Los flujos no pueden tener mensajes de usuario vacíos"
+    duplicates = {message for message in normalized if normalized.count(message) > 1}
+    if duplicates:
+        return None, f"Mensajes de usuario duplicados en los flujos: {sorted(duplicates)}"
+
+    refs = [flow.ref for flow in delta.flows.add if flow.ref]
+    if len(refs) != len(set(refs)):
+        return None, "Las referencias (ref) de los flujos nuevos deben ser únicas"
+
+    # Filas afectadas: un delta vacío no cambia la versión (ni invalida ETags)
+    changed = 0
+    if removed:
+        changed += session.query(FlowEdge).filter(
+            FlowEdge.chatbot_id == chatbot_id,
+            or_(FlowEdge.source_flow_id.in_(removed), FlowEdge.target_flow_id.in_(removed))
+        ).delete(synchronize_session=False)
+        changed += session.query(Flow).filter(Flow.chatbot_id == chatbot_id, Flow.id.in_(removed)).delete(synchronize_session=False)
+    if delta.edges.remove:
+        changed += session.query(FlowEdge).filter(
+            FlowEdge.chatbot_id == chatbot_id, FlowEdge.id.in_(delta.edges.remove)
+        ).delete(synchronize_session=False)
+
+    changes = [
+        dict(change.model_dump(exclude_none=True), id=change.id)
+        for change in delta.flows.update
+        if change.id not in removed
+    ]
+    changes = [change for change in changes if len(change) > 1]
+    if changes:
+        session.execute(update(Flow), changes)
+        changed += len(changes)
+
+    ref_ids = {}
+    if delta.flows.add:
+        next_position = max((flow.position for flow in existing.values()), default=-1) + 1
+        rows = []
+        for flow in delta.flows.add:
+            if flow.position is None:
+                flow.position = next_position
+                next_position += 1
+            rows.append(dict(flow.model_dump(exclude={'ref'}), chatbot_id=chatbot_id))
+        ids = session.scalars(insert(Flow).returning(Flow.id, sort_by_parameter_order=True), rows).all()
+        ref_ids = {flow.ref: flow_id for flow, flow_id in zip(delta.flows.add, ids) if flow.ref}
+        changed += len(ids)
+
+    valid_ids = (existing.keys() - removed) | set(ref_ids.values())
+    edge_rows = []
+    for edge in delta.edges.add:
+        source = ref_ids.get(edge.source) if isinstance(edge.source, str) else edge.source
+        target = ref_ids.get(edge.target) if isinstance(edge.target, str) else edge.target
+        if source not in valid_ids or target not in valid_ids:
+            return None, f"Edge con origen o destino inexistente: {edge.source} -> {edge.target}"
+        edge_rows.append({'chatbot_id': chatbot_id, 'source_flow_id': source, 'target_flow_id': target, 'condition': edge.condition})
+    if edge_rows:
+        session.execute(insert(FlowEdge), edge_rows)
+        changed += len(edge_rows)
+    if delta.edges.update:
+        session.execute(update(FlowEdge), [{'id': change.id, 'condition': change.condition} for change in delta.edges.update])
+        changed += len(delta.edges.update)
+
+    if changed:
+        chatbot.version = (chatbot.version or 1) + 1
+    return ref_ids, None
+
+@app.route('/api/chatbots/<int:chatbot_id>/flows', methods=['GET', 'PATCH', 'OPTIONS'])
+@jwt_required()
+def chatbot_flows(chatbot_id):
+    if request.method == 'OPTIONS':
+        return jsonify({'message': 'Preflight OK'}), 200
+
+    user_id = get_jwt_identity()
+    with get_session() as session:
+        if request.method == 'GET':
+            chatbot = session.query(Chatbot.id, Chatbot.version).filter_by(id=chatbot_id, user_id=user_id).first()
+            if not chatbot:
+                return jsonify({'status': 'error', 'message': 'Chatbot no encontrado o no tienes permisos'}), 404
+            etag = f"flows-{chatbot_id}-v{chatbot.version}"
+            if request.if_none_match.contains(etag):
+                response = Response(status=304)
+                response.set_etag(etag)
+                return response
+            flows = session.query(Flow).filter_by(chatbot_id=chatbot_id).order_by(Flow.position).all()
+            edges = session.query(FlowEdge).filter_by(chatbot_id=chatbot_id).all()
+            response = jsonify({
+                'status': 'success',
+                'version': chatbot.version,
+                'flows': [serialize_flow(flow) for flow in flows],
+                'edges': [serialize_edge(edge) for edge in edges]
+            })
+            response.set_etag(etag)
+            return response, 200
+
+        try:
+            delta = FlowPatchModel.model_validate(request.get_json() or {})
+        except ValidationError as e:
+            return jsonify({'status': 'error', 'message': f'Cambios inválidos: {str(e)}'}), 400
+
+        # Bloquea la fila del chatbot para que dos ediciones simultáneas no pisen la versión
+        chatbot = session.query(Chatbot).filter_by(id=chatbot_id, user_id=user_id).with_for_update().first()
+        if not chatbot:
+            return jsonify({'status': 'error', 'message': 'Chatbot no encontrado o no tienes permisos'}), 404
+        if delta.version is not None and delta.version != chatbot.version:
+            return jsonify({
+                'status': 'error',
+                'message': 'Los flujos cambiaron desde que los cargaste. Recarga e inténtalo de nuevo.',
+                'version': chatbot.version
+            }), 409
+
+        previous_version = chatbot.version
+        ref_ids, error = apply_flow_delta(session, chatbot, delta)
+        if error:
+            session.rollback()
+            return jsonify({'status': 'error', 'message': error}), 400
+        session.commit()
+        if chatbot.version != previous_version:
+            rebuild_flow_index(chatbot_id, session)
+        return jsonify({'status': 'success', 'version': chatbot.version, 'flow_ids': ref_ids}), 200
+
 @app.route('/chat/<int:chatbot_id>', methods=['POST'])
 def chat(chatbot_id):
     data = request.get_json()
@@ -1309,92 +2147,167 @@ def chat(chatbot_id):
         return jsonify({'status': 'error', 'message': 'Falta el mensaje o el número de teléfono'}), 400
 
     with get_session() as session:
-        chatbot = session.query(Chatbot).filter_by(id=chatbot_id).first()
-        if not chatbot:
+        profile = get_bot_profile(chatbot_id, session)
+        if not profile:
             return jsonify({'status': 'error', 'message': 'Chatbot no encontrado'}), 404
 
         user_id = user_phone
-        if not check_quota(chatbot.user_id, session):
+        if not consume_quota(profile['user_id'], session):
             return jsonify({'status': 'error', 'message': 'Has alcanzado el límite de mensajes de este mes. Actualiza tu plan para continuar.'}), 429
 
-        increment_quota(chatbot.user_id, session)
+        # La ventana se lee antes de registrar el mensaje actual, que va aparte en el prompt
+        history = load_context_window(chatbot_id, user_id, session)
+        record_conversation(chatbot_id, user_id, user_message, 'user')
 
-        conversation = Conversation(
-            chatbot_id=chatbot_id,
-            user_id=user_id,
-            message=user_message,
-            role='user'
-        )
-        session.add(conversation)
-        session.commit()
+        response = match_flow(chatbot_id, user_message, user_id)
+        if not response:
+            messages = build_chat_messages(profile, history, user_message)
+            response = call_grok(messages, max_tokens=150, chatbot_id=chatbot_id,
+                                 question=user_message, share_response=shareable_response(history))
+
+        record_conversation(chatbot_id, user_id, response, 'bot')
+        return jsonify({'response': response})
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.route('/chat/<int:chatbot_id>/stream', methods=['POST'])
+def chat_stream(chatbot_id):
+    data = request.get_json()
+    user_message = data.get('message')
+    user_phone = data.get('user_phone')
+
+    if not user_message or not user_phone:
+        return jsonify({'status': 'error', 'message': 'Falta el mensaje o el número de teléfono'}), 400
+
+    user_id = user_phone
+    with get_session() as session:
+        profile = get_bot_profile(chatbot_id, session)
+        if not profile:
+            return jsonify({'status': 'error', 'message': 'Chatbot no encontrado'}), 404
+
+        # La cuota se cuenta aquí, una sola vez, antes de abrir el stream
+        if not consume_quota(profile['user_id'], session):
+            return jsonify({'status': 'error', 'message': 'Has alcanzado el límite de mensajes de este mes. Actualiza tu plan para continuar.'}), 429
 
-        history = session.query(Conversation).filter_by(chatbot_id=chatbot_id, user_id=user_id).order_by(Conversation.timestamp.asc()).all()
-        flows = session.query(Flow).filter_by(chatbot_id=chatbot_id).order_by(Flow.position.asc()).all()
-        edges = session.query(FlowEdge).filter_by(chatbot_id=chatbot_id).all()
-
-        user_msg_lower = user_message.lower()
-        response = None
-        for flow in flows:
-            if user_msg_lower == flow.user_message.lower():
-                response = flow.bot_response
-                # Manejar acciones
-                if flow.actions:
-                    for action in flow.actions:
-                        if action['type'] == 'payment_link':
-                            # Generar enlace de pago simulado (puedes integrar Stripe aquí)
-                            amount = float(action['value'])
-                            payment_url = f"https://example.com/pay?amount={amount}"  # Reemplazar con Stripe
-                            response += f"\nPaga aquí: {payment_url}"
-                        elif action['type'] == 'schedule_link':
-                            response += f"\nAgenda una cita: {action['value']}"
-                break
+        # La ventana se lee antes de registrar el mensaje actual, que va aparte en el prompt
+        history = load_context_window(chatbot_id, user_id, session)
+        record_conversation(chatbot_id, user_id, user_message, 'user')
+        flow_response = match_flow(chatbot_id, user_message, user_id)
+        messages = None if flow_response else build_chat_messages(profile, history, user_message)
+        share_response = shareable_response(history)
 
+    def generate():
+        response = flow_response
         if not response:
-            messages = [
-                {"role": "system", "content": f"Eres un chatbot {chatbot.tone} llamado '{chatbot.name}'. Tu propósito es {chatbot.purpose}. Usa un tono {chatbot.tone} y gramática correcta."},
-                {"role": "user", "content": f"Historial: {summarize_history(history)}\nMensaje: {user_message}"}
-            ]
-            if chatbot.business_info:
-                messages[0]["content"] += f"\nNegocio: {chatbot.business_info}"
-            if chatbot.pdf_content:
-                messages[0]["content"] += f"\nContenido del PDF: {chatbot.pdf_content}"
-
-            response = call_grok(messages, max_tokens=150)
-
-        bot_conversation = Conversation(
-            chatbot_id=chatbot_id,
-            user_id=user_id,
-            message=response,
-            role='bot'
-        )
-        session.add(bot_conversation)
-        session.commit()
-        return jsonify({'response': response})
-    
+            response = response_cache.get(chatbot_id, messages[0]['content'], user_message)
+        parts = []
+        try:
+            if response:
+                yield sse_event('token', {'text': response})
+            elif not xai_rate_limiter.acquire(timeout=XAI_RATE_LIMIT_WAIT):
+                response = "Estamos atendiendo muchas consultas en este momento. Intenta de nuevo en unos segundos."
+                yield sse_event('token', {'text': response})
+            else:
+                try:
+                    for delta in llm_client.stream(messages, max_tokens=150, route='chat'):
+                        parts.append(delta)
+                        yield sse_event('token', {'text': delta})
+                    response = "".join(parts)
+                    if share_response:
+                        response_cache.set(chatbot_id, messages[0]['content'], user_message, response)
+                    record_token_usage(chatbot_id, estimate_messages_tokens(messages), estimate_tokens(response))
+                except requests.exceptions.RequestException as e:
+                    logger.exception(f"Error en streaming con xAI: {str(e)}")
+                    response = "".join(parts) or "¡Vaya! La conexión con la IA falló, intenta de nuevo en un momento."
+                    if not parts:
+                        yield sse_event('token', {'text': response})
+            yield sse_event('done', {'response': response})
+        finally:
+            # Se ejecuta también si el cliente corta la conexión a mitad del stream
+            response = response or "".join(parts)
+            if response:
+                record_conversation(chatbot_id, user_id, response, 'bot')
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+# Listado de chatbots del usuario. Cada página se cachea en el namespace bots:<user_id>, cuya
+# versión hace de contador por usuario: create_chatbot, update_bot, delete_bot y los cambios de
+# número o de mensaje de bienvenida lo incrementan con invalidate_bot_list. El ETag es el hash del
+# cuerpo, así que un sondeo sin cambios se responde con 304 sin consultar la base de datos.
+BOT_LIST_FIELDS = {
+    'id': Chatbot.id,
+    'name': Chatbot.name,
+    'tone': Chatbot.tone,
+    'purpose': Chatbot.purpose,
+    'whatsapp_number': Chatbot.whatsapp_number,
+    'initial_message': Chatbot.initial_message,
+    'business_info': Chatbot.business_info,
+    'pdf_url': Chatbot.pdf_url,
+    'image_url': Chatbot.image_url
+}
+BOT_LIST_MAX_PAGE_SIZE = int(os.getenv('BOT_LIST_MAX_PAGE_SIZE', 500))
+BOT_LIST_TTL = int(os.getenv('BOT_LIST_TTL', 3600))
+
+def invalidate_bot_list(user_id):
+    app_cache.invalidate(f"bots:{user_id}")
+
+def build_bot_list_page(session, user_id, fields, limit, cursor):
+    columns = [BOT_LIST_FIELDS[field] for field in fields]
+    query = select(Chatbot.id, *columns).where(Chatbot.user_id == user_id)
+    if cursor:
+        query = query.where(Chatbot.id > cursor)
+    query = query.order_by(Chatbot.id.asc())
+    if limit is None:
+        rows = session.execute(query).all()
+        next_cursor = None
+    else:
+        rows = session.execute(query.limit(limit + 1)).all()
+        next_cursor = str(rows[limit - 1].id) if len(rows) > limit else None
+        rows = rows[:limit]
+    chatbots = [{field: row[i + 1] for i, field in enumerate(fields)} for row in rows]
+    body = json.dumps({'status': 'success', 'chatbots': chatbots, 'next_cursor': next_cursor}, ensure_ascii=False)
+    return {'body': body, 'etag': f"bots-{hashlib.sha256(body.encode('utf-8')).hexdigest()[:16]}"}
 
 @app.route('/api/chatbots', methods=['GET', 'OPTIONS'])
+@app.route('/list-bots', methods=['GET', 'OPTIONS'])
 @jwt_required()
 def list_chatbots():
     if request.method == 'OPTIONS':
         return jsonify({'message': 'Preflight OK'}), 200
 
     user_id = get_jwt_identity()
-    with get_session() as session:
-        chatbots = session.query(Chatbot).filter_by(user_id=user_id).all()
-        chatbots_list = [
-            {
-                'id': bot.id,
-                'name': bot.name,
-                'tone': bot.tone,
-                'purpose': bot.purpose,
-                'whatsapp_number': bot.whatsapp_number,
-                'business_info': bot.business_info,
-                'pdf_url': bot.pdf_url,
-                'image_url': bot.image_url,
-                'initial_message': bot.initial_message
-            } for bot in chatbots
-        ]
-        return jsonify({'chatbots': chatbots_list}), 200
+    fields = request.args.get('fields')
+    fields = [f.strip() for f in fields.split(',') if f.strip()] if fields else list(BOT_LIST_FIELDS)
+    unknown = [f for f in fields if f not in BOT_LIST_FIELDS]
+    if unknown:
+        return jsonify({'status': 'error', 'message': f"Campos no válidos: {', '.join(unknown)}"}), 400
+    # Sin limit ni cursor se devuelven todos los chatbots, como esperan los clientes actuales
+    limit = request.args.get('limit')
+    cursor = request.args.get('cursor')
+    if cursor and not limit:
+        limit = BOT_LIST_MAX_PAGE_SIZE
+    try:
+        limit = min(max(int(limit), 1), BOT_LIST_MAX_PAGE_SIZE) if limit else None
+        cursor = int(cursor) if cursor else None
+    except (ValueError, TypeError):
+        return jsonify({'status': 'error', 'message': 'Parámetros de paginación inválidos'}), 400
+
+    key = [fields, limit, cursor]
+    page = app_cache.get(f"bots:{user_id}", key)
+    if not page:
+        with get_session() as session:
+            page = build_bot_list_page(session, user_id, fields, limit, cursor)
+        app_cache.set(f"bots:{user_id}", key, page, ttl=BOT_LIST_TTL)
+
+    if request.if_none_match.contains(page['etag']):
+        response = Response(status=304)
+    else:
+        response = Response(page['body'], mimetype='application/json')
+    response.set_etag(page['etag'])
+    return response
     
 @app.route('/connect-whatsapp', methods=['OPTIONS', 'POST'])
 @jwt_required()
@@ -1428,8 +2341,12 @@ def connect_whatsapp():
                 to=f'whatsapp:{phone_number}'
             )
             logger.info(f"Mensaje enviado a {phone_number}: {message.sid}")
+            old_number = chatbot.whatsapp_number
             chatbot.whatsapp_number = phone_number
             session.commit()
+            app_cache.invalidate(f"chatbot:{chatbot_id}")
+            set_whatsapp_route(phone_number, chatbot.id, old_number)
+            invalidate_bot_list(user_id)
             return jsonify({'status': 'success', 'message': f'Verifica tu número {phone_number} respondiendo "VERIFICAR" en WhatsApp.'}), 200
         except TwilioRestException as e:
             return jsonify({'status': 'error', 'message': f'Error con Twilio: {str(e)}. Verifica tus credenciales.'}), 500
@@ -1437,6 +2354,69 @@ def connect_whatsapp():
             logger.exception(f"Error en /connect-whatsapp: {str(e)}")
             return jsonify({'status': 'error', 'message': f'Error inesperado: {str(e)}'}), 500
         
+# Historial paginado por keyset sobre (timestamp, id): cada página continúa donde terminó la anterior
+# sin OFFSET, usando el índice (chatbot_id, timestamp, id). format=ndjson|csv exporta el historial
+# completo en streaming con un cursor del lado del servidor, con memoria constante.
+HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', 100))
+HISTORY_MAX_PAGE_SIZE = int(os.getenv('HISTORY_MAX_PAGE_SIZE', 1000))
+HISTORY_EXPORT_BATCH = int(os.getenv('HISTORY_EXPORT_BATCH', 1000))
+
+def encode_history_cursor(row):
+    raw = json.dumps([row.timestamp.isoformat(), row.id])
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+def decode_history_cursor(cursor):
+    if not cursor:
+        return None
+    timestamp, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    return datetime.fromisoformat(timestamp), int(row_id)
+
+def history_query(chatbot_id, cursor=None):
+    query = select(
+        Conversation.id, Conversation.user_id, Conversation.role, Conversation.message, Conversation.timestamp
+    ).where(Conversation.chatbot_id == chatbot_id)
+    if cursor:
+        timestamp, row_id = cursor
+        query = query.where(or_(
+            Conversation.timestamp > timestamp,
+            and_(Conversation.timestamp == timestamp, Conversation.id > row_id)
+        ))
+    return query.order_by(Conversation.timestamp.asc(), Conversation.id.asc())
+
+def serialize_history_row(row):
+    return {
+        'id': row.id,
+        'user_id': row.user_id,
+        'role': row.role,
+        'message': row.message,
+        'timestamp': row.timestamp.isoformat()
+    }
+
+def export_conversations(chatbot_id, export_format):
+    def generate():
+        if export_format == 'csv':
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(['id', 'user_id', 'role', 'message', 'timestamp'])
+        # Conexión propia: la sesión de la petición ya se cerró cuando Flask consume el generador
+        with engine.connect() as conn:
+            result = conn.execution_options(stream_results=True, yield_per=HISTORY_EXPORT_BATCH).execute(history_query(chatbot_id))
+            for batch in result.partitions():
+                if export_format == 'csv':
+                    for row in batch:
+                        writer.writerow([row.id, row.user_id, row.role, row.message, row.timestamp.isoformat()])
+                    chunk = buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+                else:
+                    chunk = ''.join(json.dumps(serialize_history_row(row), ensure_ascii=False) + '\n' for row in batch)
+                yield chunk
+
+    mimetype = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+    filename = f"conversaciones_{chatbot_id}.{export_format}"
+    return Response(stream_with_context(generate()), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"', 'X-Accel-Buffering': 'no'})
+
 @app.route('/conversation-history/<int:chatbot_id>', methods=['GET', 'OPTIONS'])
 @jwt_required()
 def conversation_history(chatbot_id):
@@ -1449,10 +2429,285 @@ def conversation_history(chatbot_id):
         if not chatbot:
             return jsonify({'status': 'error', 'message': 'Chatbot no encontrado o no tienes permisos'}), 404
 
-        history = session.query(Conversation).filter_by(chatbot_id=chatbot_id).order_by(Conversation.timestamp.asc()).all()
-        history_list = [{'role': conv.role, 'message': conv.message, 'timestamp': conv.timestamp.isoformat()} for conv in history]
-        return jsonify({'status': 'success', 'history': history_list}), 200
-        
+        export_format = request.args.get('format', 'json')
+        if export_format in ('ndjson', 'csv'):
+            return export_conversations(chatbot_id, export_format)
+        if export_format != 'json':
+            return jsonify({'status': 'error', 'message': 'Formato no soportado. Usa json, ndjson o csv'}), 400
+
+        # Sin limit ni cursor se devuelve el historial completo, como antes de paginar
+        limit = request.args.get('limit')
+        cursor = request.args.get('cursor')
+        if cursor and not limit:
+            limit = HISTORY_PAGE_SIZE
+        try:
+            limit = min(max(int(limit), 1), HISTORY_MAX_PAGE_SIZE) if limit else None
+            cursor = decode_history_cursor(cursor)
+        except (ValueError, TypeError):
+            return jsonify({'status': 'error', 'message': 'Parámetros de paginación inválidos'}), 400
+
+        query = history_query(chatbot_id, cursor)
+        if limit is None:
+            rows = session.execute(query).all()
+            next_cursor = None
+        else:
+            rows = session.execute(query.limit(limit + 1)).all()
+            next_cursor = encode_history_cursor(rows[limit - 1]) if len(rows) > limit else None
+        history_list = [serialize_history_row(row) for row in rows[:limit]]
+        return jsonify({'status': 'success', 'history': history_list, 'next_cursor': next_cursor}), 200
+
+
+@app.route('/api/cache-stats/<int:chatbot_id>', methods=['GET', 'OPTIONS'])
+@jwt_required()
+def cache_stats(chatbot_id):
+    if request.method == 'OPTIONS':
+        return jsonify({'message': 'Preflight OK'}), 200
+
+    user_id = get_jwt_identity()
+    with get_session() as session:
+        chatbot = session.query(Chatbot.id).filter_by(id=chatbot_id, user_id=user_id).first()
+        if not chatbot:
+            return jsonify({'status': 'error', 'message': 'Chatbot no encontrado o no tienes permisos'}), 404
+    return jsonify({'status': 'success', 'response_cache': response_cache.stats(chatbot_id), 'cache': app_cache.stats()}), 200
+
+@app.route('/api/token-usage/<int:chatbot_id>', methods=['GET', 'OPTIONS'])
+@jwt_required()
+def token_usage(chatbot_id):
+    if request.method == 'OPTIONS':
+        return jsonify({'message': 'Preflight OK'}), 200
+
+    user_id = get_jwt_identity()
+    month = request.args.get('month') or datetime.now(timezone.utc).strftime('%Y-%m')
+    with get_session() as session:
+        chatbot = session.query(Chatbot.id, Chatbot.prompt_token_budget).filter_by(id=chatbot_id, user_id=user_id).first()
+        if not chatbot:
+            return jsonify({'status': 'error', 'message': 'Chatbot no encontrado o no tienes permisos'}), 404
+
+    usage = {}
+    if redis_client:
+        try:
+            usage = redis_client.hgetall(token_usage_key(chatbot_id, month))
+        except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+            logger.warning(f"Error al leer uso de tokens del chatbot {chatbot_id}: {str(e)}")
+    return jsonify({
+        'status': 'success',
+        'month': month,
+        'budget': chatbot.prompt_token_budget or PROMPT_TOKEN_BUDGET,
+        'requests': int(usage.get('requests', 0)),
+        'prompt_tokens': int(usage.get('prompt_tokens', 0)),
+        'completion_tokens': int(usage.get('completion_tokens', 0))
+    }), 200
+
+@app.route('/api/rate-limits', methods=['GET', 'OPTIONS'])
+@jwt_required()
+def rate_limits():
+    if request.method == 'OPTIONS':
+        return jsonify({'message': 'Preflight OK'}), 200
+    return jsonify({'status': 'success', 'buckets': [xai_rate_limiter.level()]}), 200
+
+# Procesamiento de mensajes entrantes de WhatsApp
+# Con TWILIO_ASYNC_WEBHOOK=True el webhook responde TwiML vacío al instante y una tarea de Celery
+# construye la respuesta y la envía por la API REST. MessageSid se reclama en Redis para que los
+# reintentos de Twilio no generen llamadas al LLM ni filas de Conversation duplicadas.
+TWILIO_ASYNC_WEBHOOK = os.getenv('TWILIO_ASYNC_WEBHOOK', 'False') == 'True'
+TWILIO_DEDUP_TTL = int(os.getenv('TWILIO_DEDUP_TTL', 86400))
+
+# Índice whatsapp_number -> chatbot_id en un hash de Redis para que /webhook/whatsapp enrute por el
+# número de destino (To) con un HGET. connect_whatsapp, update_bot y delete_bot lo mantienen; si
+# falta una entrada (Redis vacío o caído) se resuelve en la base de datos y se vuelve a guardar.
+WHATSAPP_ROUTES_KEY = 'whatsapp:routes'
+
+def normalize_whatsapp_number(number):
+    return (number or '').replace('whatsapp:', '').strip()
+
+def set_whatsapp_route(number, chatbot_id, old_number=None):
+    if not redis_client:
+        return
+    try:
+        pipe = redis_client.pipeline(transaction=True)
+        if old_number and old_number != number:
+            pipe.hdel(WHATSAPP_ROUTES_KEY, old_number)
+        if number:
+            pipe.hset(WHATSAPP_ROUTES_KEY, number, chatbot_id)
+        pipe.execute()
+    except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+        logger.warning(f"Error al guardar la ruta de WhatsApp {number}: {str(e)}.")
+
+def remove_whatsapp_route(number):
+    if not redis_client or not number:
+        return
+    try:
+        redis_client.hdel(WHATSAPP_ROUTES_KEY, number)
+    except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+        logger.warning(f"Error al eliminar la ruta de WhatsApp {number}: {str(e)}.")
+
+def resolve_whatsapp_route(number, session):
+    if redis_client:
+        try:
+            chatbot_id = redis_client.hget(WHATSAPP_ROUTES_KEY, number)
+            if chatbot_id is not None:
+                return int(chatbot_id)
+        except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+            logger.warning(f"Error al leer la ruta de WhatsApp {number}: {str(e)}. Consultando la base de datos.")
+    chatbot_id = session.query(Chatbot.id).filter_by(whatsapp_number=number).scalar()
+    if chatbot_id is not None:
+        set_whatsapp_route(number, chatbot_id)
+    return chatbot_id
+
+def process_whatsapp_message(session, profile, user_id, user_message):
+    chatbot_id = profile['id']
+
+    # Validar y descontar cuota
+    if not consume_quota(profile['user_id'], session):
+        return "Has alcanzado el límite de mensajes de este mes. Actualiza tu plan para continuar."
+
+    # Historial acotado + mensaje del usuario
+    history = load_context_window(chatbot_id, user_id, session)
+    record_conversation(chatbot_id, user_id, user_message, 'user')
+
+    # Flujos predefinidos
+
+    response = match_flow(chatbot_id, user_message, user_id)
+    if not response:
+        # Si no hay coincidencia, usar IA (Grok o similar)
+        messages = build_chat_messages(profile, history, user_message)
+        response = call_grok(messages, max_tokens=150, chatbot_id=chatbot_id,
+                             question=user_message, share_response=shareable_response(history))
+
+    record_conversation(chatbot_id, user_id, response, 'bot')
+    return response
+
+def claim_message_sid(message_sid):
+    if not message_sid or not redis_client:
+        return True
+    try:
+        return bool(redis_client.set(f"twilio:sid:{message_sid}", 1, nx=True, ex=TWILIO_DEDUP_TTL))
+    except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+        logger.warning(f"Error al registrar MessageSid {message_sid}: {str(e)}. Procesando sin deduplicar.")
+        return True
+
+def release_message_sid(message_sid):
+    # Libera el MessageSid para que un reintento de Twilio vuelva a procesar el mensaje
+    if not message_sid or not redis_client:
+        return
+    try:
+        redis_client.delete(f"twilio:sid:{message_sid}")
+    except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+        logger.warning(f"Error al liberar MessageSid {message_sid}: {str(e)}.")
+
+WHATSAPP_FALLBACK_REPLY = "Lo siento, no pude procesar tu mensaje. Intenta de nuevo en unos minutos."
+
+@celery_app.task(bind=True, max_retries=3, default_retry_delay=5)
+def handle_whatsapp_message(self, chatbot_id, from_number, to_number, user_message, message_sid):
+    reply_key = f"twilio:reply:{message_sid}"
+    reply = None
+    if redis_client:
+        try:
+            reply = redis_client.get(reply_key)
+        except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+            logger.warning(f"Error al leer respuesta pendiente de {message_sid}: {str(e)}.")
+
+    # En un reintento de la tarea solo se reenvía la respuesta ya generada
+    if reply is None:
+        try:
+            with get_session() as session:
+                profile = get_bot_profile(chatbot_id, session)
+                if not profile:
+                    logger.warning(f"Chatbot {chatbot_id} no encontrado al procesar {message_sid}")
+                    return
+                reply = process_whatsapp_message(session, profile, from_number, user_message)
+        except Exception as e:
+            if self.request.retries < self.max_retries:
+                logger.warning(f"Error al procesar {message_sid} (intento {self.request.retries + 1}): {str(e)}. Reintentando.")
+                raise self.retry(exc=e)
+            # Agotados los reintentos, el usuario recibe al menos una respuesta de disculpa
+            logger.exception(f"Error al procesar {message_sid} tras {self.max_retries} reintentos: {str(e)}")
+            reply = WHATSAPP_FALLBACK_REPLY
+        if redis_client:
+            try:
+                redis_client.setex(reply_key, TWILIO_DEDUP_TTL, reply)
+            except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+                logger.warning(f"Error al guardar respuesta pendiente de {message_sid}: {str(e)}.")
+
+    try:
+        message = twilio_client.messages.create(
+            body=reply,
+            from_=to_number or f'whatsapp:{TWILIO_PHONE}',
+            to=from_number
+        )
+        logger.info(f"Respuesta enviada a {from_number} para {message_sid}: {message.sid}")
+    except TwilioRestException as e:
+        logger.exception(f"Error al enviar respuesta de WhatsApp para {message_sid}: {str(e)}")
+        if self.request.retries >= self.max_retries:
+            release_message_sid(message_sid)
+        raise self.retry(exc=e)
+
+def verify_whatsapp_number(session, chatbot_id, from_number):
+    chatbot = session.query(Chatbot).filter_by(id=chatbot_id).first()
+    chatbot.is_verified = True
+    session.commit()
+    twilio_client.messages.create(
+        body="¡Número verificado! Tu chatbot está listo para usar.",
+        from_=f'whatsapp:{TWILIO_PHONE}',
+        to=from_number
+    )
+
+def reply_whatsapp_message(session, profile, data, from_number, user_message):
+    chatbot_id = profile['id']
+    logger.info(f"Mensaje recibido en webhook para chatbot {chatbot_id}: {user_message} desde {from_number}")
+
+    if TWILIO_ASYNC_WEBHOOK:
+        message_sid = data.get('MessageSid', '')
+        if not claim_message_sid(message_sid):
+            logger.info(f"MessageSid {message_sid} ya recibido, ignorando reintento de Twilio")
+        else:
+            try:
+                handle_whatsapp_message.delay(chatbot_id, from_number, data.get('To', ''), user_message, message_sid)
+            except Exception as e:
+                # Sin liberar el MessageSid, el reintento de Twilio se ignoraría y el mensaje se perdería
+                logger.exception(f"No se pudo encolar el mensaje {message_sid}: {str(e)}")
+                release_message_sid(message_sid)
+                return jsonify({'status': 'error', 'message': 'No se pudo procesar el mensaje'}), 500
+        return Response(str(MessagingResponse()), mimetype='text/xml')
+
+    response = process_whatsapp_message(session, profile, from_number, user_message)
+    twilio_response = MessagingResponse()
+    twilio_response.message(response)
+    return Response(str(twilio_response), mimetype='text/xml')
+
+@app.route('/webhook/whatsapp', methods=['POST'])
+def whatsapp_webhook():
+    # Un único endpoint para todos los números: el chatbot se resuelve por el número de destino
+    data = request.form.to_dict()
+    from_number = data.get('From', '')
+    to_number = normalize_whatsapp_number(data.get('To'))
+    user_message = data.get('Body', '').strip()
+
+    if not from_number or not to_number or not user_message:
+        logger.warning("Mensaje, número de origen o de destino no proporcionado")
+        return jsonify({'status': 'error', 'message': 'Falta el número o el mensaje'}), 400
+
+    with get_session() as session:
+        # Las respuestas "VERIFICAR" de connect_whatsapp llegan al número de Plubot desde el del chatbot;
+        # cualquier otro mensaje a ese número se enruta como los demás (puede estar asignado a un chatbot)
+        if to_number == TWILIO_PHONE and user_message.lower() == 'verificar':
+            chatbot_id = resolve_whatsapp_route(normalize_whatsapp_number(from_number), session)
+            if chatbot_id is not None:
+                verify_whatsapp_number(session, chatbot_id, from_number)
+                return jsonify({'status': 'success', 'message': 'Verificado'}), 200
+
+        chatbot_id = resolve_whatsapp_route(to_number, session)
+        profile = get_bot_profile(chatbot_id, session) if chatbot_id is not None else None
+        if profile and profile['whatsapp_number'] != to_number:
+            # Ruta desactualizada (el número cambió de chatbot): se descarta y se consulta la base de datos
+            remove_whatsapp_route(to_number)
+            chatbot_id = resolve_whatsapp_route(to_number, session)
+            profile = get_bot_profile(chatbot_id, session) if chatbot_id is not None else None
+        if not profile:
+            logger.warning(f"Ningún chatbot tiene asignado el número {to_number}")
+            return jsonify({'status': 'error', 'message': 'Chatbot no encontrado'}), 404
+
+        return reply_whatsapp_message(session, profile, data, from_number, user_message)
 
 @app.route('/webhook/<int:chatbot_id>', methods=['POST'])
 def webhook(chatbot_id):
@@ -1465,98 +2720,26 @@ def webhook(chatbot_id):
         return jsonify({'status': 'error', 'message': 'Falta el número o el mensaje'}), 400
 
     with get_session() as session:
-        chatbot = session.query(Chatbot).filter_by(id=chatbot_id).first()
-        if not chatbot:
+        profile = get_bot_profile(chatbot_id, session)
+        if not profile:
             logger.warning(f"Chatbot {chatbot_id} no encontrado")
             return jsonify({'status': 'error', 'message': 'Chatbot no encontrado'}), 404
 
-        if not chatbot.whatsapp_number:
+        if not profile['whatsapp_number']:
             logger.warning(f"Chatbot {chatbot_id} no tiene número de WhatsApp configurado")
             return Response(status=404)
 
         # Validar que el número coincida con el registrado
-        if chatbot.whatsapp_number != from_number.replace('whatsapp:', ''):
+        if profile['whatsapp_number'] != from_number.replace('whatsapp:', ''):
             logger.warning(f"Número no coincide: {from_number}")
             return jsonify({'status': 'error', 'message': 'Número de WhatsApp no coincide'}), 403
 
-        user_id = from_number
-
         # Verificación explícita del número
         if user_message.lower() == 'verificar':
-            chatbot.is_verified = True
-            session.commit()
-            twilio_client.messages.create(
-                body="¡Número verificado! Tu chatbot está listo para usar.",
-                from_=f'whatsapp:{TWILIO_PHONE}',
-                to=from_number
-            )
+            verify_whatsapp_number(session, chatbot_id, from_number)
             return jsonify({'status': 'success', 'message': 'Verificado'}), 200
 
-        logger.info(f"Mensaje recibido en webhook para chatbot {chatbot_id}: {user_message} desde {from_number}")
-
-        # Validar cuota
-        if not check_quota(chatbot.user_id, session):
-            twilio_response = MessagingResponse()
-            twilio_response.message("Has alcanzado el límite de mensajes de este mes. Actualiza tu plan para continuar.")
-            return Response(str(twilio_response), mimetype='text/xml')
-
-        increment_quota(chatbot.user_id, session)
-
-        # Guardar mensaje del usuario
-        conversation = Conversation(
-            chatbot_id=chatbot_id,
-            user_id=user_id,
-            message=user_message,
-            role='user'
-        )
-        session.add(conversation)
-        session.commit()
-
-        # Historial + Flujos predefinidos
-        history = session.query(Conversation).filter_by(chatbot_id=chatbot_id, user_id=user_id).order_by(Conversation.timestamp.asc()).all()
-        flows = session.query(Flow).filter_by(chatbot_id=chatbot_id).order_by(Flow.position.asc()).all()
-
-        user_msg_lower = user_message.lower()
-        for flow in flows:
-            if user_msg_lower == flow.user_message.lower():
-                response = flow.bot_response
-                bot_conversation = Conversation(
-                    chatbot_id=chatbot_id,
-                    user_id=user_id,
-                    message=response,
-                    role='bot'
-                )
-                session.add(bot_conversation)
-                session.commit()
-
-                twilio_response = MessagingResponse()
-                twilio_response.message(response)
-                return Response(str(twilio_response), mimetype='text/xml')
-
-        # Si no hay coincidencia, usar IA (Grok o similar)
-        messages = [
-            {"role": "system", "content": f"Eres un chatbot {chatbot.tone} llamado '{chatbot.name}'. Tu propósito es {chatbot.purpose}. Usa un tono {chatbot.tone} y gramática correcta."},
-            {"role": "user", "content": f"Historial: {summarize_history(history)}\nMensaje: {user_message}"}
-        ]
-        if chatbot.business_info:
-            messages[0]["content"] += f"\nNegocio: {chatbot.business_info}"
-        if chatbot.pdf_content:
-            messages[0]["content"] += f"\nContenido del PDF: {chatbot.pdf_content}"
-
-        response = call_grok(messages, max_tokens=150)
-
-        bot_conversation = Conversation(
-            chatbot_id=chatbot_id,
-            user_id=user_id,
-            message=response,
-            role='bot'
-        )
-        session.add(bot_conversation)
-        session.commit()
-
-        twilio_response = MessagingResponse()
-        twilio_response.message(response)
-        return Response(str(twilio_response), mimetype='text/xml')
+        return reply_whatsapp_message(session, profile, data, from_number, user_message)
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
@@ -0,0 +1,329 @@
+import hashlib
+import json
+import logging
+import random
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+import redis
+
+logger = logging.getLogger(__name__)
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+
+def normalize_question(text):
+    text = unicodedata.normalize('NFKD', (text or "").lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    text = re.sub(r"[^\w\s]", " ", text)
+    return " ".join(text.split())
+
+
+def shingles(text, k=3):
+    if len(text) <= k:
+        return {text}
+    return {text[i:i + k] for i in range(len(text) - k + 1)}
+
+
+def _hash64(value):
+    return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class MinHasher:
+    """Firma MinHash sobre shingles de caracteres; estima la similitud de Jaccard entre dos textos."""
+
+    def __init__(self, num_perm=64, seed=1):
+        rng = random.Random(seed)
+        self.num_perm = num_perm
+        self.permutations = [
+            (rng.randint(1, _MERSENNE_PRIME - 1), rng.randint(0, _MERSENNE_PRIME - 1))
+            for _ in range(num_perm)
+        ]
+
+    def signature(self, text):
+        hashes = [_hash64(s) for s in shingles(text)]
+        return [
+            min(((a * h + b) % _MERSENNE_PRIME) & _MAX_HASH for h in hashes)
+            for a, b in self.permutations
+        ]
+
+    @staticmethod
+    def similarity(sig1, sig2):
+        if not sig1 or len(sig1) != len(sig2):
+            return 0.0
+        return sum(1 for x, y in zip(sig1, sig2) if x == y) / len(sig1)
+
+
+class TwoTierCache:
+    """Caché en dos niveles: LRU acotada en el proceso (L1) delante de Redis (L2).
+
+    Las claves se reducen a un digest SHA-256 de tamaño fijo y viven en un namespace versionado
+    (cache:<namespace>:<versión>:<digest>). invalidate() solo incrementa la versión del namespace,
+    así que descartar todas las entradas de un chatbot cuesta O(1); las entradas viejas expiran
+    solas por TTL en Redis y por LRU en L1. Otros procesos ven la nueva versión en como mucho
+    namespace_refresh segundos.
+
+    Sin Redis no hay forma de propagar invalidaciones entre procesos, así que la caché entera
+    se desactiva en lugar de servir L1 desactualizada. Los valores deben ser serializables a
+    JSON y no deben mutarse tras leerlos de L1.
+    """
+
+    def __init__(self, get_redis, max_entries=4096, max_bytes=32 * 1024 * 1024, default_ttl=3600,
+                 namespace_refresh=2.0, prefix='cache'):
+        self.get_redis = get_redis
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.namespace_refresh = namespace_refresh
+        self.prefix = prefix
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._namespaces = {}
+        self._lock = threading.Lock()
+        self._counters = {'l1_hits': 0, 'l2_hits': 0, 'misses': 0, 'evictions': 0}
+
+    @staticmethod
+    def digest(key):
+        if not isinstance(key, str):
+            key = json.dumps(key, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def _namespace_version(self, namespace):
+        now = time.monotonic()
+        cached = self._namespaces.get(namespace)
+        if cached and now - cached[1] < self.namespace_refresh:
+            return cached[0]
+        version = cached[0] if cached else 0
+        client = self.get_redis()
+        if client:
+            try:
+                version = int(client.get(f"{self.prefix}:ns:{namespace}") or 0)
+            except redis.exceptions.RedisError as e:
+                logger.warning(f"Error al leer versión del namespace {namespace}: {str(e)}")
+        self._namespaces[namespace] = (version, now)
+        return version
+
+    def namespace_prefix(self, namespace):
+        return f"{self.prefix}:{namespace}:{self._namespace_version(namespace)}"
+
+    def make_key(self, namespace, key):
+        return f"{self.namespace_prefix(namespace)}:{self.digest(key)}"
+
+    def _l1_get(self, full_key):
+        with self._lock:
+            entry = self._entries.get(full_key)
+            if not entry:
+                return None
+            expires_at, size, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[full_key]
+                self._bytes -= size
+                return None
+            self._entries.move_to_end(full_key)
+            return entry
+
+    def _l1_set(self, full_key, value, size, ttl):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(full_key, None)
+            if old:
+                self._bytes -= old[1]
+            self._entries[full_key] = (time.monotonic() + ttl, size, value)
+            self._bytes += size
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self._counters['evictions'] += 1
+
+    def get(self, namespace, key):
+        client = self.get_redis()
+        if not client:
+            self._counters['misses'] += 1
+            return None
+
+        full_key = self.make_key(namespace, key)
+        entry = self._l1_get(full_key)
+        if entry:
+            self._counters['l1_hits'] += 1
+            return entry[2]
+
+        try:
+            pipe = client.pipeline(transaction=False)
+            pipe.get(full_key)
+            pipe.ttl(full_key)
+            raw, ttl = pipe.execute()
+            if raw is not None:
+                value = json.loads(raw)
+                self._l1_set(full_key, value, len(raw), ttl if ttl and ttl > 0 else self.default_ttl)
+                self._counters['l2_hits'] += 1
+                return value
+        except redis.exceptions.RedisError as e:
+            logger.warning(f"Error al leer desde Redis: {str(e)}. Continuando sin caché.")
+        self._counters['misses'] += 1
+        return None
+
+    def set(self, namespace, key, value, ttl=None):
+        client = self.get_redis()
+        if not client:
+            return
+        ttl = ttl or self.default_ttl
+        full_key = self.make_key(namespace, key)
+        raw = json.dumps(value, ensure_ascii=False)
+        try:
+            client.setex(full_key, ttl, raw)
+        except redis.exceptions.RedisError as e:
+            logger.warning(f"Error al guardar en Redis: {str(e)}. Continuando sin caché.")
+            return
+        self._l1_set(full_key, value, len(raw), ttl)
+
+    def invalidate(self, namespace):
+        version = self._namespace_version(namespace) + 1
+        client = self.get_redis()
+        if client:
+            try:
+                version = client.incr(f"{self.prefix}:ns:{namespace}")
+            except redis.exceptions.RedisError as e:
+                logger.warning(f"Error al invalidar namespace {namespace}: {str(e)}")
+        self._namespaces[namespace] = (version, time.monotonic())
+        logger.info(f"Namespace de caché {namespace} invalidado (versión {version})")
+        return version
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, l1_entries=len(self._entries), l1_bytes=self._bytes)
+
+
+class ResponseCache:
+    """Caché de respuestas del LLM por chatbot.
+
+    La clave es la pregunta normalizada más un hash del prompt de sistema, así que el historial
+    de cada cliente no la fragmenta. Las preguntas casi idénticas se encuentran con LSH sobre
+    bandas de la firma MinHash y se sirven si superan el umbral de similitud.
+
+    Las entradas viven en el namespace chatbot:<id> de la TwoTierCache, de modo que invalidarlo
+    descarta también las bandas. Claves en Redis:
+        <namespace>:<digest>                      pregunta, firma y respuesta (también en L1)
+        <namespace>:rc:<prompt>:b:<i>:<banda>     conjunto de hashes de pregunta
+        rcache:stats:<chatbot>                    contadores hits / similar_hits / misses
+    """
+
+    def __init__(self, cache, threshold=0.85, ttl=3600, num_perm=64, bands=16, min_chars=8, max_candidates=20):
+        if num_perm % bands:
+            raise ValueError("num_perm debe ser múltiplo de bands")
+        self.cache = cache
+        self.get_redis = cache.get_redis
+        self.threshold = threshold
+        self.ttl = ttl
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.min_chars = min_chars
+        self.max_candidates = max_candidates
+        self.hasher = MinHasher(num_perm=num_perm)
+
+    @staticmethod
+    def _prompt_hash(system_prompt):
+        return hashlib.sha256(system_prompt.encode('utf-8')).hexdigest()[:16]
+
+    def _prefix(self, chatbot_id, prompt_hash):
+        return f"{self.cache.namespace_prefix(f'chatbot:{chatbot_id}')}:rc:{prompt_hash}"
+
+    def _band_keys(self, prefix, signature):
+        keys = []
+        for i in range(self.bands):
+            band = signature[i * self.rows:(i + 1) * self.rows]
+            band_hash = hashlib.blake2b(",".join(map(str, band)).encode('utf-8'), digest_size=8).hexdigest()
+            keys.append(f"{prefix}:b:{i}:{band_hash}")
+        return keys
+
+    def _record(self, client, chatbot_id, outcome):
+        try:
+            client.hincrby(f"rcache:stats:{chatbot_id}", outcome, 1)
+        except redis.exceptions.RedisError as e:
+            logger.warning(f"Error al registrar estadísticas de caché: {str(e)}")
+
+    def get(self, chatbot_id, system_prompt, question):
+        normalized = normalize_question(question)
+        if len(normalized) < self.min_chars:
+            return None
+
+        namespace = f"chatbot:{chatbot_id}"
+        prompt_hash = self._prompt_hash(system_prompt)
+        question_hash = self.cache.digest(normalized)
+        client = self.get_redis()
+        if not client:
+            return None
+        entry = self.cache.get(namespace, ['rc', prompt_hash, question_hash])
+        if entry:
+            self._record(client, chatbot_id, 'hits')
+            logger.info(f"Respuesta obtenida desde caché para chatbot {chatbot_id}")
+            return entry['response']
+
+        prefix = self._prefix(chatbot_id, prompt_hash)
+        try:
+            signature = self.hasher.signature(normalized)
+            pipe = client.pipeline(transaction=False)
+            for key in self._band_keys(prefix, signature):
+                pipe.smembers(key)
+            candidates = set()
+            for members in pipe.execute():
+                candidates.update(members)
+            candidates = list(candidates)[:self.max_candidates]
+
+            best, best_score = None, 0.0
+            for candidate in candidates:
+                entry = self.cache.get(namespace, ['rc', prompt_hash, candidate])
+                if entry:
+                    score = MinHasher.similarity(signature, entry['signature'])
+                    if score > best_score:
+                        best, best_score = entry, score
+            if best and best_score >= self.threshold:
+                self._record(client, chatbot_id, 'similar_hits')
+                logger.info(f"Respuesta similar ({best_score:.2f}) obtenida desde caché para chatbot {chatbot_id}")
+                return best['response']
+        except redis.exceptions.RedisError as e:
+            logger.warning(f"Error al leer desde caché de respuestas: {str(e)}. Continuando sin caché.")
+            return None
+
+        self._record(client, chatbot_id, 'misses')
+        return None
+
+    def set(self, chatbot_id, system_prompt, question, response):
+        normalized = normalize_question(question)
+        if len(normalized) < self.min_chars:
+            return
+
+        client = self.get_redis()
+        if not client:
+            return
+        namespace = f"chatbot:{chatbot_id}"
+        prompt_hash = self._prompt_hash(system_prompt)
+        question_hash = self.cache.digest(normalized)
+        signature = self.hasher.signature(normalized)
+        self.cache.set(namespace, ['rc', prompt_hash, question_hash],
+                       {'question': normalized, 'signature': signature, 'response': response}, ttl=self.ttl)
+        prefix = self._prefix(chatbot_id, prompt_hash)
+        try:
+            pipe = client.pipeline(transaction=False)
+            for key in self._band_keys(prefix, signature):
+                pipe.sadd(key, question_hash)
+                pipe.expire(key, self.ttl)
+            pipe.execute()
+        except redis.exceptions.RedisError as e:
+            logger.warning(f"Error al guardar en caché de respuestas: {str(e)}. Continuando sin caché.")
+
+    def stats(self, chatbot_id):
+        client = self.get_redis()
+        counters = {'hits': 0, 'similar_hits': 0, 'misses': 0}
+        if client:
+            try:
+                counters.update({k: int(v) for k, v in client.hgetall(f"rcache:stats:{chatbot_id}").items()})
+            except redis.exceptions.RedisError as e:
+                logger.warning(f"Error al leer estadísticas de caché: {str(e)}")
+        total = counters['hits'] + counters['similar_hits'] + counters['misses']
+        counters['hit_rate'] = round((counters['hits'] + counters['similar_hits']) / total, 4) if total else 0.0
+        return counters
@@ -0,0 +1,144 @@
+import hashlib
+import io
+import re
+import threading
+import unicodedata
+from collections import Counter, OrderedDict
+
+import numpy as np
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text):
+    # Minúsculas y sin acentos para que "envío" y "envio" cuenten como el mismo término
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return [t for t in TOKEN_RE.findall(text) if len(t) > 1]
+
+
+def chunk_text(text, chunk_words=120, overlap=30):
+    # Ventanas de palabras solapadas para no cortar una respuesta entre dos fragmentos
+    words = text.split()
+    if not words:
+        return []
+    step = max(chunk_words - overlap, 1)
+    chunks = []
+    for start in range(0, len(words), step):
+        chunks.append(" ".join(words[start:start + chunk_words]))
+        if start + chunk_words >= len(words):
+            break
+    return chunks
+
+
+class BM25Index:
+    """Índice BM25 sobre los fragmentos del PDF de un chatbot.
+
+    Las listas de postings se guardan por término en formato CSC (indptr/doc_ids/tfs) y se
+    serializan con np.savez_compressed sin pickle, junto con el vocabulario y los textos de
+    los fragmentos. search() solo recorre los postings de los términos de la consulta.
+    """
+
+    def __init__(self, chunks, vocabulary, indptr, doc_ids, tfs, doc_lengths, k1=1.5, b=0.75):
+        self.chunks = chunks
+        self.vocabulary = vocabulary
+        self.indptr = indptr
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.doc_lengths = doc_lengths
+        self.k1 = k1
+        self.b = b
+        n_docs = len(chunks)
+        df = np.diff(indptr).astype(np.float32)
+        self.idf = np.log(1 + (n_docs - df + 0.5) / (df + 0.5)).astype(np.float32)
+        self.avg_length = float(doc_lengths.mean()) if n_docs else 0.0
+
+    @classmethod
+    def build(cls, chunks, **kwargs):
+        counts = [Counter(tokenize(chunk)) for chunk in chunks]
+        vocabulary = {term: i for i, term in enumerate(sorted(set().union(*counts)))}
+        postings = [[] for _ in vocabulary]
+        for doc_id, counter in enumerate(counts):
+            for term, tf in counter.items():
+                postings[vocabulary[term]].append((doc_id, tf))
+        indptr = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(p) for p in postings])
+        flat = [pair for p in postings for pair in p]
+        doc_ids = np.array([d for d, _ in flat], dtype=np.int32)
+        tfs = np.array([tf for _, tf in flat], dtype=np.float32)
+        doc_lengths = np.array([sum(c.values()) for c in counts], dtype=np.float32)
+        return cls(chunks, vocabulary, indptr, doc_ids, tfs, doc_lengths, **kwargs)
+
+    def search(self, query, k=3):
+        if not self.chunks:
+            return []
+        scores = np.zeros(len(self.chunks), dtype=np.float32)
+        norm = self.k1 * (1 - self.b + self.b * self.doc_lengths / (self.avg_length or 1.0))
+        for term in set(tokenize(query)):
+            t = self.vocabulary.get(term)
+            if t is None:
+                continue
+            docs = self.doc_ids[self.indptr[t]:self.indptr[t + 1]]
+            tf = self.tfs[self.indptr[t]:self.indptr[t + 1]]
+            scores[docs] += self.idf[t] * tf * (self.k1 + 1) / (tf + norm[docs])
+        # De más a menos relevante: el armado del prompt descarta los últimos si no caben
+        top = np.argsort(-scores, kind='stable')[:k]
+        return [self.chunks[i] for i in top if scores[i] > 0]
+
+    def to_bytes(self):
+        terms = sorted(self.vocabulary, key=self.vocabulary.get)
+        buffer = io.BytesIO()
+        np.savez_compressed(
+            buffer,
+            chunks=np.array(self.chunks, dtype=np.str_),
+            terms=np.array(terms, dtype=np.str_),
+            indptr=self.indptr, doc_ids=self.doc_ids, tfs=self.tfs, doc_lengths=self.doc_lengths
+        )
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data, **kwargs):
+        with np.load(io.BytesIO(data), allow_pickle=False) as arrays:
+            chunks = arrays['chunks'].tolist()
+            vocabulary = {term: i for i, term in enumerate(arrays['terms'].tolist())}
+            return cls(chunks, vocabulary, arrays['indptr'], arrays['doc_ids'], arrays['tfs'],
+                       arrays['doc_lengths'], **kwargs)
+
+
+def build_index_bytes(text, chunk_words=120, overlap=30):
+    chunks = chunk_text(text or "", chunk_words, overlap)
+    if not chunks:
+        return None
+    return BM25Index.build(chunks).to_bytes()
+
+
+def index_digest(data):
+    return hashlib.sha256(data).hexdigest()[:16] if data else None
+
+
+class IndexCache:
+    """LRU en proceso de índices ya deserializados, por (chatbot_id, digest) del índice."""
+
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, chatbot_id, digest, load):
+        key = (chatbot_id, digest)
+        with self._lock:
+            index = self._entries.get(key)
+            if index is not None:
+                self._entries.move_to_end(key)
+                return index
+        data = load()
+        if not data:
+            return None
+        # Si el perfil cacheado era anterior al índice guardado, se usa el índice actual
+        key = (chatbot_id, index_digest(data))
+        index = BM25Index.from_bytes(data)
+        with self._lock:
+            self._entries[key] = index
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return index
@@ -0,0 +1,172 @@
+import argparse
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def parse_route_timeouts(value, defaults=None):
+    # "chat=30,api=10" -> {'chat': 30.0, 'api': 10.0}
+    timeouts = dict(defaults or {})
+    for item in (value or "").split(','):
+        if '=' in item:
+            route, seconds = item.split('=', 1)
+            timeouts[route.strip()] = float(seconds)
+    return timeouts
+
+
+class LLMClient:
+    """Cliente compartido para la API de chat completions de xAI (o cualquier servidor compatible).
+
+    Reutiliza una única requests.Session con pool de conexiones keep-alive, limita las llamadas
+    concurrentes del proceso y aplica un presupuesto de tiempo por ruta que cubre también los
+    reintentos ante 429/5xx. Un stream ocupa su hueco de concurrencia hasta que se cierra la
+    respuesta, no solo hasta recibir las cabeceras. base_url puede apuntar a un servidor local
+    (ver run_stub_server) para pruebas y cargas sin tocar la API real.
+    """
+
+    def __init__(self, api_key, base_url='https://api.x.ai/v1', model='grok-2-1212', max_concurrency=16,
+                 pool_size=16, retries=2, timeouts=None, default_timeout=30, connect_timeout=5):
+        self.url = base_url.rstrip('/') + '/chat/completions'
+        self.model = model
+        self.retries = retries
+        self.timeouts = timeouts or {}
+        self.default_timeout = default_timeout
+        self.connect_timeout = connect_timeout
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"})
+
+    def _payload(self, messages, max_tokens, temperature, **extra):
+        payload = {"model": self.model, "messages": messages, "temperature": temperature, "max_tokens": max_tokens}
+        payload.update(extra)
+        return payload
+
+    def post(self, payload, route='chat', stream=False):
+        # Con stream=True la respuesta se devuelve con el hueco del semáforo aún ocupado: quien la
+        # consume debe llamar a release_slot() al cerrarla (stream() ya lo hace)
+        deadline = time.monotonic() + self.timeouts.get(route, self.default_timeout)
+        attempt = 0
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not self._semaphore.acquire(timeout=remaining):
+                raise requests.exceptions.Timeout(f"Presupuesto de tiempo agotado para la ruta '{route}'")
+            keep_slot = False
+            try:
+                remaining = max(deadline - time.monotonic(), 0.001)
+                response = self.session.post(self.url, json=payload, stream=stream,
+                                             timeout=(min(self.connect_timeout, remaining), remaining))
+                delay = None
+                if response.status_code in RETRY_STATUSES and attempt < self.retries:
+                    retry_after = response.headers.get('Retry-After', '')
+                    delay = float(retry_after) if retry_after.isdigit() else 2 ** attempt
+                    if time.monotonic() + delay >= deadline:
+                        delay = None
+                if delay is None:
+                    try:
+                        response.raise_for_status()
+                    except requests.exceptions.HTTPError:
+                        response.close()
+                        raise
+                    keep_slot = stream
+                    return response
+                logger.warning(f"xAI respondió {response.status_code}, reintentando en {delay}s (ruta {route})")
+                response.close()
+            finally:
+                if not keep_slot:
+                    self._semaphore.release()
+            # La espera entre reintentos no ocupa hueco de concurrencia
+            time.sleep(delay)
+            attempt += 1
+
+    def release_slot(self):
+        self._semaphore.release()
+
+    def complete(self, messages, max_tokens=150, temperature=0.5, route='chat'):
+        response = self.post(self._payload(messages, max_tokens, temperature), route=route)
+        return response.json()['choices'][0]['message']['content']
+
+    def stream(self, messages, max_tokens=150, temperature=0.5, route='chat'):
+        # Genera los fragmentos de texto a medida que llegan por SSE desde la API
+        # El hueco de concurrencia se libera al terminar, fallar o cerrarse el generador
+        response = self.post(self._payload(messages, max_tokens, temperature, stream=True), route=route, stream=True)
+        response.encoding = 'utf-8'
+        try:
+            with response:
+                for line in response.iter_lines(decode_unicode=True):
+                    if not line or not line.startswith('data:'):
+                        continue
+                    data = line[len('data:'):].strip()
+                    if data == '[DONE]':
+                        break
+                    delta = json.loads(data)['choices'][0].get('delta', {}).get('content')
+                    if delta:
+                        yield delta
+        finally:
+            self.release_slot()
+
+    def close(self):
+        self.session.close()
+
+
+def run_stub_server(host='127.0.0.1', port=8089, latency=0.0):
+    # Servidor local compatible con /v1/chat/completions que responde con un eco del último mensaje
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            time.sleep(latency)
+            messages = body.get('messages') or [{}]
+            content = f"[stub] {messages[-1].get('content', '')}"[:body.get('max_tokens', 150) * 4]
+            if body.get('stream'):
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Connection', 'close')
+                self.end_headers()
+                for word in content.split(' '):
+                    chunk = {"choices": [{"index": 0, "delta": {"content": word + ' '}}]}
+                    self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+                    self.wfile.flush()
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.close_connection = True
+                return
+            data = json.dumps({
+                "id": "stub",
+                "model": body.get('model'),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}]
+            }).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    server = ThreadingHTTPServer((host, port), StubHandler)
+    logger.info(f"Servidor LLM de prueba escuchando en http://{host}:{port}/v1")
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Servidor local que imita la API de xAI (usar XAI_API_URL=http://host:puerto/v1)")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency', type=float, default=0.0, help="segundos de espera por respuesta")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    run_stub_server(args.host, args.port, args.latency).serve_forever()
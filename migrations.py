@@ -0,0 +1,265 @@
+"""Migraciones versionadas del esquema de Plubot.
+
+Uso:
+    python migrations.py upgrade   # aplica las migraciones pendientes y siembra las plantillas si cambiaron
+    python migrations.py status    # lista migraciones aplicadas y pendientes
+    python migrations.py check     # EXPLAIN de las consultas calientes: verifica que usan sus índices
+
+Cada migración es una función que recibe la conexión dentro de una transacción y se registra en
+la tabla schema_migrations. Para cambios que SQLAlchemy no modela (particiones, índices parciales,
+CREATE INDEX CONCURRENTLY) basta con ejecutar SQL directo desde la función.
+"""
+import argparse
+import logging
+import sys
+
+from sqlalchemy import Column, DateTime, LargeBinary, MetaData, String, Table, inspect, select, text
+from sqlalchemy.sql import func
+
+from app import Base, PDFDocument, engine, sync_templates, templates_digest, KNOWLEDGE_CHUNK_WORDS, KNOWLEDGE_CHUNK_OVERLAP
+from knowledge import build_index_bytes, index_digest
+
+logger = logging.getLogger(__name__)
+
+migrations_metadata = MetaData()
+schema_migrations = Table(
+    'schema_migrations', migrations_metadata,
+    Column('version', String, primary_key=True),
+    Column('description', String, nullable=False),
+    Column('applied_at', DateTime, server_default=func.now())
+)
+# Hash de contenido de los datos sembrados (p. ej. plantillas) para sembrar solo si cambiaron
+schema_seeds = Table(
+    'schema_seeds', migrations_metadata,
+    Column('name', String, primary_key=True),
+    Column('digest', String(64), nullable=False),
+    Column('applied_at', DateTime, server_default=func.now())
+)
+
+# Clave del advisory lock de PostgreSQL para que dos despliegues no migren a la vez
+MIGRATION_LOCK_ID = 727274
+
+
+def baseline(conn):
+    # Crea las tablas que falten; en bases existentes no toca las tablas ya creadas
+    Base.metadata.create_all(conn)
+
+
+def hot_query_indexes(conn):
+    # Fusiona cuotas duplicadas (creadas por la carrera de check_quota) antes del índice único
+    conn.execute(text("""
+        UPDATE message_quotas SET message_count = (
+            SELECT SUM(m2.message_count) FROM message_quotas m2
+            WHERE m2.user_id = message_quotas.user_id AND m2.month = message_quotas.month
+        )
+        WHERE id IN (SELECT MIN(id) FROM message_quotas GROUP BY user_id, month HAVING COUNT(*) > 1)
+    """))
+    conn.execute(text("""
+        DELETE FROM message_quotas
+        WHERE id NOT IN (SELECT MIN(id) FROM message_quotas GROUP BY user_id, month)
+    """))
+    for statement in (
+        "CREATE INDEX IF NOT EXISTS ix_conversations_chatbot_user_timestamp ON conversations (chatbot_id, user_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS ix_flows_chatbot_position ON flows (chatbot_id, position)",
+        "CREATE INDEX IF NOT EXISTS ix_flow_edges_chatbot_id ON flow_edges (chatbot_id)",
+        "CREATE INDEX IF NOT EXISTS ix_chatbots_user_id ON chatbots (user_id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_message_quotas_user_month ON message_quotas (user_id, month)",
+    ):
+        conn.execute(text(statement))
+
+
+def history_keyset_index(conn):
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_conversations_chatbot_timestamp_id ON conversations (chatbot_id, timestamp, id)"
+    ))
+
+
+def pdf_knowledge_index(conn):
+    columns = {c['name'] for c in inspect(conn).get_columns('chatbots')}
+    if 'pdf_index' not in columns:
+        column_type = LargeBinary().compile(dialect=conn.dialect)
+        conn.execute(text(f"ALTER TABLE chatbots ADD COLUMN pdf_index {column_type}"))
+    # Indexa los PDF ya procesados para que no vuelvan a enviarse completos al LLM, un texto por
+    # consulta para no cargar todos los PDF a la vez
+    ids = conn.execute(text(
+        "SELECT id FROM chatbots WHERE pdf_content IS NOT NULL AND pdf_index IS NULL"
+    )).scalars().all()
+    for chatbot_id in ids:
+        pdf_content = conn.execute(text("SELECT pdf_content FROM chatbots WHERE id = :id"), {'id': chatbot_id}).scalar()
+        conn.execute(
+            text("UPDATE chatbots SET pdf_index = :pdf_index WHERE id = :id"),
+            {'id': chatbot_id, 'pdf_index': build_index_bytes(pdf_content, KNOWLEDGE_CHUNK_WORDS, KNOWLEDGE_CHUNK_OVERLAP)}
+        )
+
+
+def pdf_documents(conn):
+    PDFDocument.__table__.create(conn, checkfirst=True)
+    columns = {c['name'] for c in inspect(conn).get_columns('chatbots')}
+    if 'pdf_sha256' not in columns:
+        conn.execute(text("ALTER TABLE chatbots ADD COLUMN pdf_sha256 VARCHAR(64)"))
+
+
+def prompt_token_budget(conn):
+    columns = {c['name'] for c in inspect(conn).get_columns('chatbots')}
+    if 'prompt_token_budget' not in columns:
+        conn.execute(text("ALTER TABLE chatbots ADD COLUMN prompt_token_budget INTEGER"))
+
+
+def chatbot_version(conn):
+    columns = {c['name'] for c in inspect(conn).get_columns('chatbots')}
+    if 'version' not in columns:
+        conn.execute(text("ALTER TABLE chatbots ADD COLUMN version INTEGER NOT NULL DEFAULT 1"))
+
+
+def pdf_index_digest(conn):
+    columns = {c['name'] for c in inspect(conn).get_columns('chatbots')}
+    if 'pdf_index_digest' not in columns:
+        conn.execute(text("ALTER TABLE chatbots ADD COLUMN pdf_index_digest VARCHAR(16)"))
+    # Un índice por consulta para no cargar todos los blobs a la vez
+    ids = conn.execute(text(
+        "SELECT id FROM chatbots WHERE pdf_index IS NOT NULL AND pdf_index_digest IS NULL"
+    )).scalars().all()
+    for chatbot_id in ids:
+        data = conn.execute(text("SELECT pdf_index FROM chatbots WHERE id = :id"), {'id': chatbot_id}).scalar()
+        conn.execute(
+            text("UPDATE chatbots SET pdf_index_digest = :digest WHERE id = :id"),
+            {'id': chatbot_id, 'digest': index_digest(data)}
+        )
+
+
+MIGRATIONS = [
+    ('0001', 'Esquema inicial', baseline),
+    ('0002', 'Índices de consultas calientes y cuota única por usuario y mes', hot_query_indexes),
+    ('0003', 'Índice de paginación por keyset del historial', history_keyset_index),
+    ('0004', 'Índice BM25 de fragmentos del PDF por chatbot', pdf_knowledge_index),
+    ('0005', 'Documentos PDF deduplicados por SHA-256', pdf_documents),
+    ('0006', 'Presupuesto de tokens del prompt por chatbot', prompt_token_budget),
+    ('0007', 'Versión de flujos por chatbot', chatbot_version),
+    ('0008', 'Digest del índice del PDF por chatbot', pdf_index_digest),
+]
+
+# Consultas del camino caliente y el índice que debe usar cada una
+HOT_QUERIES = [
+    (
+        'ventana de contexto',
+        "SELECT role, message FROM conversations WHERE chatbot_id = :chatbot_id AND user_id = :user_id "
+        "ORDER BY timestamp DESC, id DESC LIMIT 10",
+        {'chatbot_id': 1, 'user_id': '+10000000000'},
+        'ix_conversations_chatbot_user_timestamp'
+    ),
+    (
+        'historial paginado',
+        "SELECT id, user_id, role, message, timestamp FROM conversations WHERE chatbot_id = :chatbot_id "
+        "AND (timestamp > :timestamp OR (timestamp = :timestamp AND id > :id)) ORDER BY timestamp, id LIMIT 100",
+        {'chatbot_id': 1, 'timestamp': '2025-01-01 00:00:00', 'id': 0},
+        'ix_conversations_chatbot_timestamp_id'
+    ),
+    (
+        'flujos por chatbot',
+        "SELECT id, user_message, bot_response FROM flows WHERE chatbot_id = :chatbot_id ORDER BY position",
+        {'chatbot_id': 1},
+        'ix_flows_chatbot_position'
+    ),
+    (
+        'edges por chatbot',
+        "SELECT source_flow_id, target_flow_id, condition FROM flow_edges WHERE chatbot_id = :chatbot_id",
+        {'chatbot_id': 1},
+        'ix_flow_edges_chatbot_id'
+    ),
+    (
+        'cuota mensual',
+        "SELECT id, message_count, plan FROM message_quotas WHERE user_id = :user_id AND month = :month",
+        {'user_id': 1, 'month': '2025-01'},
+        'uq_message_quotas_user_month'
+    ),
+]
+
+
+def seed_templates(conn):
+    digest = templates_digest()
+    current = conn.execute(
+        select(schema_seeds.c.digest).where(schema_seeds.c.name == 'templates')
+    ).scalar()
+    if current == digest:
+        logger.info("Plantillas sin cambios desde el último despliegue")
+        return False
+    sync_templates(conn)
+    if current is None:
+        conn.execute(schema_seeds.insert().values(name='templates', digest=digest))
+    else:
+        conn.execute(
+            schema_seeds.update().where(schema_seeds.c.name == 'templates').values(digest=digest, applied_at=func.now())
+        )
+    return True
+
+
+def applied_versions(conn):
+    migrations_metadata.create_all(conn)
+    return {row.version for row in conn.execute(schema_migrations.select())}
+
+
+def upgrade():
+    with engine.begin() as conn:
+        if conn.dialect.name == 'postgresql':
+            conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {'id': MIGRATION_LOCK_ID})
+        applied = applied_versions(conn)
+        pending = [m for m in MIGRATIONS if m[0] not in applied]
+        for version, description, migrate in pending:
+            logger.info(f"Aplicando migración {version}: {description}")
+            migrate(conn)
+            conn.execute(schema_migrations.insert().values(version=version, description=description))
+        seed_templates(conn)
+    if pending:
+        logger.info(f"Migraciones aplicadas: {', '.join(m[0] for m in pending)}")
+    else:
+        logger.info("El esquema ya está actualizado")
+    return pending
+
+
+def status():
+    with engine.begin() as conn:
+        applied = applied_versions(conn)
+    for version, description, _ in MIGRATIONS:
+        print(f"{version} [{'aplicada' if version in applied else 'pendiente'}] {description}")
+
+
+def explain(conn, sql, params):
+    if conn.dialect.name == 'postgresql':
+        rows = conn.execute(text(f"EXPLAIN {sql}"), params).fetchall()
+        return "\n".join(row[0] for row in rows)
+    rows = conn.execute(text(f"EXPLAIN QUERY PLAN {sql}"), params).fetchall()
+    return "\n".join(str(row[-1]) for row in rows)
+
+
+def check():
+    ok = True
+    with engine.begin() as conn:
+        if conn.dialect.name == 'postgresql':
+            # Con tablas pequeñas el planificador prefiere seq scan; aquí solo interesa que el índice sea utilizable
+            conn.execute(text("SET LOCAL enable_seqscan = off"))
+        existing = set(inspect(conn).get_table_names())
+        for name, sql, params, index in HOT_QUERIES:
+            table = sql.split(' FROM ')[1].split()[0]
+            if table not in existing:
+                print(f"[FALTA] {name}: la tabla {table} no existe, ejecuta 'python migrations.py upgrade'")
+                ok = False
+                continue
+            plan = explain(conn, sql, params)
+            uses_index = index in plan
+            ok = ok and uses_index
+            print(f"[{'OK' if uses_index else 'SIN ÍNDICE'}] {name}: {index}")
+            if not uses_index:
+                print("\n".join(f"    {line}" for line in plan.splitlines()))
+    return ok
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Migraciones del esquema de Plubot")
+    parser.add_argument('command', choices=['upgrade', 'status', 'check'])
+    args = parser.parse_args()
+    if args.command == 'upgrade':
+        upgrade()
+    elif args.command == 'status':
+        status()
+    elif not check():
+        sys.exit(1)
@@ -0,0 +1,126 @@
+import hashlib
+import logging
+import multiprocessing
+import os
+import tempfile
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import magic
+import PyPDF2
+import requests
+
+logger = logging.getLogger(__name__)
+
+PDF_MIME_TYPES = ('application/pdf', 'application/x-pdf')
+
+
+class PDFIngestError(Exception):
+    pass
+
+
+DownloadedPDF = namedtuple('DownloadedPDF', ['path', 'sha256', 'size', 'etag', 'last_modified'])
+
+
+def download_pdf(url, max_bytes, timeout=(5, 30), chunk_size=64 * 1024, etag=None, last_modified=None):
+    """Descarga el PDF a un archivo temporal sin cargarlo entero en memoria.
+
+    Corta la descarga en cuanto supera max_bytes (se anuncie o no en Content-Length) y comprueba
+    con python-magic que los primeros bytes son de verdad un PDF. Con etag/last_modified de una
+    descarga anterior hace un GET condicional y devuelve None si el servidor responde 304. Si no,
+    devuelve un DownloadedPDF con la ruta del archivo (el llamador debe borrarlo), el SHA-256 del
+    contenido y los validadores de la respuesta.
+    """
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    with requests.get(url, stream=True, timeout=timeout, headers=headers) as response:
+        if response.status_code == 304:
+            logger.info(f"PDF de {url} sin cambios (304)")
+            return None
+        response.raise_for_status()
+        declared = response.headers.get('Content-Length')
+        if declared and declared.isdigit() and int(declared) > max_bytes:
+            raise PDFIngestError(f"El PDF ocupa {int(declared)} bytes y el máximo es {max_bytes}")
+
+        fd, path = tempfile.mkstemp(prefix='plubot-pdf-', suffix='.pdf')
+        try:
+            size = 0
+            head = b""
+            digest = hashlib.sha256()
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    size += len(chunk)
+                    if size > max_bytes:
+                        raise PDFIngestError(f"El PDF supera el máximo de {max_bytes} bytes")
+                    if len(head) < 2048:
+                        head += chunk[:2048 - len(head)]
+                    digest.update(chunk)
+                    f.write(chunk)
+            mime = magic.from_buffer(head, mime=True) if head else 'application/x-empty'
+            if mime not in PDF_MIME_TYPES:
+                raise PDFIngestError(f"El archivo descargado no es un PDF (tipo detectado: {mime})")
+            logger.info(f"PDF descargado de {url}: {size} bytes en {path}")
+            return DownloadedPDF(path, digest.hexdigest(), size, response.headers.get('ETag'),
+                                 response.headers.get('Last-Modified'))
+        except Exception:
+            os.unlink(path)
+            raise
+
+
+def iter_pages(reader, path, start, end):
+    for number in range(start, end):
+        started = time.perf_counter()
+        try:
+            text = reader.pages[number].extract_text() or ""
+        except Exception as e:
+            logger.warning(f"No se pudo extraer la página {number + 1} de {path}: {str(e)}")
+            text = ""
+        yield number, text, time.perf_counter() - started
+
+
+def extract_page_range(path, start, end):
+    # Cada proceso abre su propio lector: los objetos de PyPDF2 no se pueden compartir entre procesos
+    return list(iter_pages(PyPDF2.PdfReader(path), path, start, end))
+
+
+def can_fork_workers():
+    # Los procesos del pool prefork de Celery son daemon y no pueden crear procesos hijos
+    return not multiprocessing.current_process().daemon
+
+
+def extract_text(path, workers=4, pages_per_task=8, progress=None):
+    """Extrae el texto de todas las páginas, en paralelo por bloques de pages_per_task páginas.
+
+    El paralelismo solo se usa con un pool de procesos. Dentro de un worker daemon (el pool
+    prefork de Celery) no se pueden crear procesos, e hilos no sirven: PyPDF2 es Python puro y
+    retiene el GIL, y cada bloque volvería a parsear el PDF entero. En ese caso se hace una sola
+    pasada con un único lector. progress(hechas, total, segundos_de_la_página) se llama por cada
+    página terminada. El texto se une una sola vez al final, en el orden original de las páginas.
+    """
+    reader = PyPDF2.PdfReader(path)
+    total = len(reader.pages)
+    ranges = [(start, min(start + pages_per_task, total)) for start in range(0, total, pages_per_task)]
+    texts = [""] * total
+    done = 0
+
+    def collect(pages):
+        nonlocal done
+        for number, text, seconds in pages:
+            texts[number] = text
+            done += 1
+            if progress:
+                progress(done, total, seconds)
+
+    if workers <= 1 or len(ranges) <= 1 or not can_fork_workers():
+        for page in iter_pages(reader, path, 0, total):
+            collect([page])
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(ranges))) as executor:
+            futures = [executor.submit(extract_page_range, path, start, end) for start, end in ranges]
+            for future in as_completed(futures):
+                collect(future.result())
+    return "\n".join(texts)
@@ -0,0 +1,135 @@
+import math
+import re
+
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+PIECE_RE = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+
+# Tokens extra que la API cuenta por mensaje (rol y separadores)
+MESSAGE_OVERHEAD = 4
+# Etiquetas fijas del prompt ("Negocio:", "Información relevante del PDF:", "Historial:"...)
+LABEL_TOKENS = 24
+
+
+def estimate_tokens(text):
+    # Aproximación local a un tokenizador BPE: una palabra ocupa ~1 token por cada 4 caracteres
+    # y cada signo de puntuación cuenta como uno. No requiere el tokenizador del modelo.
+    if not text:
+        return 0
+    tokens = 0
+    for piece in PIECE_RE.findall(text):
+        tokens += math.ceil(len(piece) / 4) if WORD_RE.fullmatch(piece) else 1
+    return tokens
+
+
+def estimate_messages_tokens(messages):
+    return sum(estimate_tokens(m.get('content', '')) + MESSAGE_OVERHEAD for m in messages)
+
+
+def truncate_to_tokens(text, max_tokens):
+    if max_tokens <= 0 or not text:
+        return ""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    used = 0
+    end = 0
+    for match in PIECE_RE.finditer(text):
+        piece = match.group()
+        cost = math.ceil(len(piece) / 4) if WORD_RE.fullmatch(piece) else 1
+        if used + cost > max_tokens - 1:
+            break
+        used += cost
+        end = match.end()
+    return text[:end].rstrip() + "…"
+
+
+class PromptBuilder:
+    """Arma los mensajes para el LLM sin pasarse de un presupuesto de tokens.
+
+    Las secciones se reparten el presupuesto por prioridad: mensaje del usuario (hasta la mitad
+    del presupuesto), prompt de sistema, información del negocio (hasta business_share del
+    presupuesto, para que quede sitio al contexto de la pregunta), fragmentos del PDF (en orden
+    de relevancia, enteros mientras quepan) e historial (de lo más reciente a lo más antiguo;
+    lo que no cabe se condensa en un resumen). Lo que no cabe se recorta o se omite, y build()
+    devuelve junto a los mensajes el uso de tokens por sección.
+    """
+
+    def __init__(self, budget, business_share=0.4, summary_tokens=60, min_section_tokens=16):
+        self.budget = budget
+        self.business_share = business_share
+        self.summary_tokens = summary_tokens
+        self.min_section_tokens = min_section_tokens
+
+    def build(self, system_prompt, user_message, business_info=None, knowledge=(), history=()):
+        remaining = self.budget - 2 * MESSAGE_OVERHEAD - LABEL_TOKENS
+        usage = {'budget': self.budget, 'truncated': []}
+
+        def take(name, text, limit=None):
+            nonlocal remaining
+            cap = remaining if limit is None else min(limit, remaining)
+            result = truncate_to_tokens(text, cap)
+            if result != text:
+                usage['truncated'].append(name)
+            cost = estimate_tokens(result)
+            usage[name] = cost
+            remaining -= cost
+            return result
+
+        user_message = take('user', user_message, limit=self.budget // 2)
+        system_prompt = take('system', system_prompt)
+        if business_info:
+            business_info = take('business_info', business_info, limit=int(self.budget * self.business_share))
+
+        selected = []
+        usage['knowledge'] = 0
+        for chunk in knowledge:
+            cost = estimate_tokens(chunk) + 1
+            if cost <= remaining:
+                selected.append(chunk)
+            elif not selected and remaining >= self.min_section_tokens:
+                chunk = truncate_to_tokens(chunk, remaining - 1)
+                selected.append(chunk)
+                cost = estimate_tokens(chunk) + 1
+            else:
+                usage['truncated'].append('knowledge')
+                break
+            usage['knowledge'] += cost
+            remaining -= cost
+
+        turns = []
+        usage['history'] = 0
+        history = list(history)
+        kept = 0
+        for conv in reversed(history):
+            line = f"{conv['role']}: {conv['message']}"
+            cost = estimate_tokens(line) + 1
+            if cost > remaining - self.summary_tokens:
+                break
+            turns.append(line)
+            usage['history'] += cost
+            remaining -= cost
+            kept += 1
+        turns.reverse()
+        older = history[:len(history) - kept]
+        if older:
+            usage['truncated'].append('history')
+            summary = truncate_to_tokens("Resumen: " + " ".join(c['message'][:50] for c in older), remaining)
+            if summary:
+                turns.insert(0, summary)
+                cost = estimate_tokens(summary) + 1
+                usage['history'] += cost
+                remaining -= cost
+
+        system_content = system_prompt
+        if business_info:
+            system_content += f"\nNegocio: {business_info}"
+        history_text = "\n".join(turns)
+        user_content = f"Historial: {history_text}\nMensaje: {user_message}"
+        if selected:
+            user_content = "Información relevante del PDF:\n" + "\n---\n".join(selected) + "\n" + user_content
+
+        messages = [
+            {"role": "system", "content": system_content},
+            {"role": "user", "content": user_content}
+        ]
+        usage['total'] = estimate_messages_tokens(messages)
+        return messages, usage
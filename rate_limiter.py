@@ -0,0 +1,97 @@
+import logging
+import threading
+import time
+
+import redis
+
+logger = logging.getLogger(__name__)
+
+# Recarga el bucket según el tiempo del servidor Redis (sin depender del reloj de cada worker)
+# y descuenta los tokens pedidos si alcanzan. Devuelve {permitido, espera_en_segundos, tokens}.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local data = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(data[1])
+local ts = tonumber(data[2])
+if tokens == nil then
+    tokens = capacity
+    ts = now
+end
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+local wait = 0
+if tokens >= requested then
+    tokens = tokens - requested
+    allowed = 1
+else
+    wait = (requested - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+return {allowed, tostring(wait), tostring(tokens)}
+"""
+
+
+class TokenBucket:
+    """Token bucket compartido por todos los workers y tareas de Celery a través de Redis.
+
+    acquire() nunca duerme más allá del plazo indicado: si no hay token a tiempo devuelve False
+    y el llamador responde con su alternativa rápida. Si Redis no está disponible se usa un
+    bucket local del proceso, con el mismo ritmo pero sin coordinación entre workers.
+    """
+
+    def __init__(self, get_redis, name, rate, capacity):
+        self.get_redis = get_redis
+        self.name = name
+        self.key = f"ratelimit:{name}"
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._script = None
+        self._script_client = None
+        self._lock = threading.Lock()
+        self._local_tokens = self.capacity
+        self._local_ts = time.monotonic()
+
+    def _run(self, requested):
+        client = self.get_redis()
+        if client:
+            try:
+                if self._script is None or self._script_client is not client:
+                    self._script = client.register_script(TOKEN_BUCKET_SCRIPT)
+                    self._script_client = client
+                allowed, wait, tokens = self._script(keys=[self.key], args=[self.rate, self.capacity, requested])
+                return bool(int(allowed)), float(wait), float(tokens)
+            except redis.exceptions.RedisError as e:
+                logger.warning(f"Error en el rate limiter '{self.name}' con Redis: {str(e)}. Usando bucket local.")
+
+        with self._lock:
+            now = time.monotonic()
+            self._local_tokens = min(self.capacity, self._local_tokens + (now - self._local_ts) * self.rate)
+            self._local_ts = now
+            if self._local_tokens >= requested:
+                self._local_tokens -= requested
+                return True, 0.0, self._local_tokens
+            return False, (requested - self._local_tokens) / self.rate, self._local_tokens
+
+    def try_acquire(self, tokens=1):
+        allowed, wait, _ = self._run(tokens)
+        return allowed, wait
+
+    def acquire(self, timeout=0.0, tokens=1):
+        deadline = time.monotonic() + timeout
+        while True:
+            allowed, wait = self.try_acquire(tokens)
+            if allowed:
+                return True
+            remaining = deadline - time.monotonic()
+            if wait > remaining:
+                return False
+            time.sleep(wait)
+
+    def level(self):
+        _, _, tokens = self._run(0)
+        return {'name': self.name, 'tokens': round(tokens, 2), 'capacity': self.capacity, 'rate_per_second': self.rate}
@@ -0,0 +1,155 @@
+import argparse
+import json
+import logging
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import redis
+
+logger = logging.getLogger(__name__)
+
+
+def twilio_number_fetcher(client, account_sid, page_size=1000):
+    # Recorre el inventario página a página sin cargar la lista entera de objetos en memoria
+    def fetch():
+        incoming = client.api.accounts(account_sid).incoming_phone_numbers
+        return (number.phone_number for number in incoming.stream(page_size=page_size))
+    return fetch
+
+
+class NumberRegistry:
+    """Registro local de los números entrantes de la cuenta de Twilio.
+
+    Los números se guardan como un set de Redis (key) compartido por todos los procesos, o en un
+    set del proceso si Redis no está disponible, así que comprobar un número cuesta un SISMEMBER.
+    refresh() descarga el inventario con fetch() y reemplaza el set de forma atómica. La renovación
+    periódica es cosa de la tarea de Celery beat; contains() solo descarga en la petición cuando los
+    datos tienen más de stale_after segundos (varias veces el intervalo de beat, es decir, beat no
+    está corriendo), o cuando un número no aparece (por si se acaba de comprar) y la última descarga
+    tiene más de min_refresh_interval segundos. fetch puede ser cualquier callable que devuelva
+    números, lo que permite probarlo contra run_stub_server o una lista fija.
+    """
+
+    def __init__(self, fetch, get_redis, key='twilio:numbers', stale_after=1800, min_refresh_interval=30):
+        self.fetch = fetch
+        self.get_redis = get_redis
+        self.key = key
+        self.stale_after = stale_after
+        self.min_refresh_interval = min_refresh_interval
+        self._numbers = frozenset()
+        self._refreshed_at = None
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        with self._lock:
+            numbers = frozenset(self.fetch())
+            now = time.time()
+            client = self.get_redis()
+            if client:
+                staging = f"{self.key}:staging:{uuid.uuid4().hex}"
+                try:
+                    pipe = client.pipeline(transaction=True)
+                    if numbers:
+                        pipe.sadd(staging, *numbers)
+                        pipe.rename(staging, self.key)
+                    else:
+                        pipe.delete(self.key)
+                    pipe.set(f"{self.key}:refreshed_at", now)
+                    pipe.execute()
+                except redis.exceptions.RedisError as e:
+                    logger.warning(f"Error al guardar los números de Twilio en Redis: {str(e)}. Usando registro en memoria.")
+            self._numbers = numbers
+            self._refreshed_at = now
+        logger.info(f"Registro de números de Twilio actualizado: {len(numbers)} números")
+        return len(numbers)
+
+    def _lookup(self, number):
+        # Devuelve (está, momento de la última descarga); primero Redis, después el set del proceso
+        client = self.get_redis()
+        if client:
+            try:
+                pipe = client.pipeline(transaction=False)
+                pipe.sismember(self.key, number)
+                pipe.get(f"{self.key}:refreshed_at")
+                found, refreshed_at = pipe.execute()
+                if refreshed_at is not None:
+                    return bool(found), float(refreshed_at)
+            except redis.exceptions.RedisError as e:
+                logger.warning(f"Error al consultar los números de Twilio en Redis: {str(e)}. Usando registro en memoria.")
+        return number in self._numbers, self._refreshed_at
+
+    def contains(self, number):
+        found, refreshed_at = self._lookup(number)
+        age = time.time() - refreshed_at if refreshed_at is not None else None
+        if age is None or age > self.stale_after or (not found and age > self.min_refresh_interval):
+            self.refresh()
+            found = number in self._numbers
+        return found
+
+    def stats(self):
+        return {'numbers': len(self._numbers), 'refreshed_at': self._refreshed_at}
+
+
+def run_stub_server(host='127.0.0.1', port=8090, numbers=(), latency=0.0):
+    # Servidor local que imita GET /2010-04-01/Accounts/<sid>/IncomingPhoneNumbers.json con paginación
+    numbers = list(numbers)
+
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if not url.path.endswith('/IncomingPhoneNumbers.json'):
+                self.send_error(404)
+                return
+            params = parse_qs(url.query)
+            page = int(params.get('Page', ['0'])[0])
+            page_size = int(params.get('PageSize', ['50'])[0])
+            time.sleep(latency)
+            records = numbers[page * page_size:(page + 1) * page_size]
+            next_page_uri = None
+            if (page + 1) * page_size < len(numbers):
+                next_page_uri = f"{url.path}?PageSize={page_size}&Page={page + 1}"
+            data = json.dumps({
+                'incoming_phone_numbers': [
+                    {'sid': f"PN{i:032d}", 'phone_number': number, 'friendly_name': number}
+                    for i, number in enumerate(records, start=page * page_size)
+                ],
+                'page': page,
+                'page_size': page_size,
+                'uri': self.path,
+                'next_page_uri': next_page_uri,
+                'previous_page_uri': None,
+                'first_page_uri': f"{url.path}?PageSize={page_size}&Page=0",
+                'start': page * page_size,
+                'end': page * page_size + len(records) - 1
+            }).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    server = ThreadingHTTPServer((host, port), StubHandler)
+    logger.info(f"Servidor Twilio de prueba escuchando en http://{host}:{port} con {len(numbers)} números")
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Servidor local que imita el listado de números de Twilio (usar TWILIO_API_URL=http://host:puerto)")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--numbers', default='', help="números separados por comas")
+    parser.add_argument('--count', type=int, default=0, help="genera N números ficticios además de --numbers")
+    parser.add_argument('--latency', type=float, default=0.0, help="segundos de espera por página")
+    args = parser.parse_args()
+    numbers = [n.strip() for n in args.numbers.split(',') if n.strip()]
+    numbers += [f"+1555{i:07d}" for i in range(args.count)]
+    logging.basicConfig(level=logging.INFO)
+    run_stub_server(args.host, args.port, numbers, args.latency).serve_forever()
@@ -0,0 +1,188 @@
+import atexit
+import csv
+import io
+import logging
+import os
+import queue
+import threading
+import time
+
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+
+logger = logging.getLogger(__name__)
+
+
+class BatchWriter:
+    """Escritura diferida de filas en lotes para una tabla de SQLAlchemy.
+
+    submit() solo encola la fila; un hilo del proceso la inserta junto con las demás en una única
+    transacción (COPY en PostgreSQL, executemany en el resto) en cuanto se junta batch_size filas
+    o pasan flush_interval segundos desde la primera fila del lote. Si la cola se llena, la fila
+    se escribe en el acto para no perderla. close() vacía la cola y se registra con atexit.
+
+    Con parent=(columna, columna_padre) las filas cuyo padre ya no existe (p. ej. de un chatbot
+    eliminado mientras estaban en cola) se descartan en la misma transacción del insert, y
+    discard() las quita de la cola del proceso. Un error de integridad no se reintenta: el lote
+    se parte hasta aislar las filas inválidas.
+    """
+
+    def __init__(self, engine, table, batch_size=200, flush_interval=0.5, max_queue=10000, max_attempts=3,
+                 parent=None):
+        self.engine = engine
+        self.table = table
+        self.columns = [c.name for c in table.columns if not c.primary_key]
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.max_attempts = max_attempts
+        self.parent = parent
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._thread = None
+        self._stopping = threading.Event()
+        atexit.register(self.close)
+
+    def _ensure_started(self):
+        # El hilo se crea en cada proceso (workers de gunicorn/Celery) la primera vez que se usa
+        if self._pid == os.getpid() and self._thread and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread and self._thread.is_alive():
+                return
+            if self._pid != os.getpid():
+                self._queue = queue.Queue(maxsize=self.max_queue)
+                self._pid = os.getpid()
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name=f"batch-writer-{self.table.name}", daemon=True)
+            self._thread.start()
+
+    def submit(self, row):
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            logger.warning(f"Cola de escritura de {self.table.name} llena; insertando en el acto")
+            self._write([row])
+
+    def _collect(self, first):
+        rows = [first]
+        deadline = time.monotonic() + self.flush_interval
+        while len(rows) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                rows.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return rows
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                first = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            self._write(self._collect(first))
+
+    def _drain(self):
+        rows = []
+        while True:
+            try:
+                rows.append(self._queue.get_nowait())
+            except (queue.Empty, AttributeError):
+                return rows
+
+    def _existing_parents(self, conn, rows):
+        column, parent_column = self.parent
+        ids = {row.get(column) for row in rows}
+        return set(conn.execute(select(parent_column).where(parent_column.in_(ids))).scalars())
+
+    def _insert(self, rows):
+        with self.engine.begin() as conn:
+            if self.parent:
+                existing = self._existing_parents(conn, rows)
+                kept = [row for row in rows if row.get(self.parent[0]) in existing]
+                if len(kept) < len(rows):
+                    logger.info(f"Se descartaron {len(rows) - len(kept)} filas de {self.table.name} cuyo {self.parent[0]} ya no existe")
+                rows = kept
+                if not rows:
+                    return
+            if conn.dialect.name == 'postgresql':
+                self._copy(conn, rows)
+            else:
+                conn.execute(self.table.insert(), rows)
+
+    def _isolate(self, rows):
+        # Parte el lote por la mitad hasta dejar fuera solo las filas que violan una restricción
+        try:
+            self._insert(rows)
+            return 0
+        except IntegrityError as e:
+            if len(rows) == 1:
+                logger.warning(f"Fila descartada de {self.table.name} por error de integridad: {str(e.orig)}")
+                return 1
+        except Exception as e:
+            logger.exception(f"Error al insertar {len(rows)} filas en {self.table.name}: {str(e)}")
+            return len(rows)
+        middle = len(rows) // 2
+        return self._isolate(rows[:middle]) + self._isolate(rows[middle:])
+
+    def _write(self, rows):
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                self._insert(rows)
+                return
+            except IntegrityError:
+                # Error permanente: reintentar el mismo lote no sirve de nada
+                discarded = self._isolate(rows)
+                if discarded:
+                    logger.error(f"Se descartaron {discarded} filas de {self.table.name} por errores de integridad")
+                return
+            except Exception as e:
+                logger.exception(f"Error al insertar lote de {len(rows)} filas en {self.table.name} (intento {attempt}): {str(e)}")
+                if attempt < self.max_attempts:
+                    time.sleep(0.2 * attempt)
+        logger.error(f"Se descartaron {len(rows)} filas de {self.table.name} tras {self.max_attempts} intentos")
+
+    def _copy(self, conn, rows):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, quoting=csv.QUOTE_ALL)
+        for row in rows:
+            writer.writerow([row.get(column) for column in self.columns])
+        buffer.seek(0)
+        cursor = conn.connection.cursor()
+        try:
+            cursor.copy_expert(
+                f"COPY {self.table.name} ({', '.join(self.columns)}) FROM STDIN WITH (FORMAT csv)",
+                buffer
+            )
+        finally:
+            cursor.close()
+
+    def discard(self, predicate):
+        # Quita de la cola del proceso las filas que cumplen predicate (las demás conservan su orden)
+        if self._pid != os.getpid() or self._queue is None:
+            return 0
+        rows = self._drain()
+        kept = [row for row in rows if not predicate(row)]
+        for row in kept:
+            self.submit(row)
+        return len(rows) - len(kept)
+
+    def flush(self):
+        if self._pid != os.getpid():
+            return
+        rows = self._drain()
+        for i in range(0, len(rows), self.batch_size):
+            self._write(rows[i:i + self.batch_size])
+
+    def close(self, timeout=5.0):
+        if self._pid != os.getpid():
+            return
+        self._stopping.set()
+        if self._thread and self._thread.is_alive():
+            self._thread.join(timeout)
+        self.flush()